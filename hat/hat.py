@@ -10,7 +10,7 @@
 from __future__ import print_function
 import time, os, sys
 import json
-from pypilot.client import pypilotClient
+from pypilot.client import pypilotClient, ClientValues
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import lcd, gpio, arduino, lirc, buzzer
@@ -170,7 +170,7 @@ class Hat(object):
         self.servo_timeout = time.time() + 1
         
         self.longsleep = 30
-        self.last_msg = {}
+        self.last_msg = ClientValues()
 
         self.client = False
         self.lcd = lcd.LCD(self)
@@ -234,13 +234,12 @@ class Hat(object):
         
         def on_con(client):
             self.value_list = client.list_values(10)
+            if self.value_list:
+                self.last_msg.info.update(self.value_list)
 
             self.watchlist = ['ap.enabled', 'ap.heading_command'] + self.lcd.watchlist
-            for name in self.watchlist:
-                client.watch(name)
-
-            for request in self.lcd.initial_gets:
-                client.get(request)
+            client.watch_many(self.watchlist)
+            client.get_many(self.lcd.initial_gets)
 
         try:
             self.client = pypilotClient(on_con, host)
@@ -273,21 +272,16 @@ class Hat(object):
         if not self.client:
             self.connect()
 
-        while self.client:
-            result = False
+        msgs = []
+        if self.client:
             try:
-                result = self.client.receive_single()
+                msgs = list(self.client.messages())
             except Exception as e:
                 print('disconnected', e)
                 self.client = False
+        self.last_msg.update(msgs)
 
-            if not result:
-                break
-
-            name, data = result
-            if 'value' in data:
-                self.last_msg[name] = data['value']
-
+        for name, data in msgs:
             for token in ['min', 'max', 'choices', 'AutopilotGain']:
                 if token in data:
                     # print('name', name, token, ' = ', data[token])
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# asyncio client and server speaking the pypilot line protocol,
+# for applications already running an event loop (python 3 only)
+#
+#   client = await pypilotAsyncClient.connect('localhost')
+#   heading = await client.get('imu.heading')
+#   await client.set('ap.enabled', True)
+#   async for name, value in client.watch('imu.*'):
+#       ...
+
+import asyncio, socket, time
+
+from pypilot import pyjson
+from pypilot.client import pypilotClient, DEFAULT_PORT
+from pypilot.server import pypilotServer, default_persistent_path, max_connections
+from pypilot.localsocket import UNIX_SOCKET_PATH, BindUnixSocket
+
+class pypilotAsyncClient(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.values = {} # latest value received for each name
+        self.gets = {} # futures waiting on each name
+        self.watches = {} # queues of each watch by name or pattern
+        self.lists = [] # futures waiting on list responses
+        self.task = asyncio.ensure_future(self.receive())
+
+    # local servers are reached through their unix domain socket if available
+    @classmethod
+    async def connect(cls, host='localhost', port=DEFAULT_PORT):
+        if host in ['localhost', '127.0.0.1'] and hasattr(socket, 'AF_UNIX'):
+            try:
+                reader, writer = await asyncio.open_unix_connection(UNIX_SOCKET_PATH % port)
+                return cls(reader, writer)
+            except OSError:
+                pass
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+    flatten_line = pypilotClient.flatten_line
+
+    async def receive(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            try:
+                msg = pyjson.loads(line)
+            except Exception:
+                print('invalid message from server:', line)
+                continue
+
+            msgs = self.flatten_line(msg)
+            if not msgs or not 'value' in msgs[0][1]: # list response
+                if self.lists:
+                    self.lists.pop(0).set_result(dict(msgs))
+                continue
+            for name, data in msgs:
+                self.dispatch(name, data['value'])
+
+        # wake everything waiting on this connection
+        for futures in list(self.gets.values()) + [self.lists]:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionError('pypilot server disconnected'))
+        for queues in self.watches.values():
+            for queue in queues:
+                queue.put_nowait(None)
+
+    def dispatch(self, name, value):
+        self.values[name] = value
+        for future in self.gets.pop(name, ()):
+            if not future.done():
+                future.set_result(value)
+
+        for key, queues in self.watches.items():
+            if key == name or (key.endswith('*') and name.startswith(key[:-1])):
+                for queue in queues:
+                    queue.put_nowait((name, value))
+
+    async def send(self, request):
+        self.writer.write((pyjson.dumps(request) + '\n').encode())
+        await self.writer.drain()
+
+    async def get(self, name, timeout=None):
+        future = asyncio.get_event_loop().create_future()
+        self.gets.setdefault(name, []).append(future)
+        await self.send({'method': 'get', 'name': name})
+        return await asyncio.wait_for(future, timeout)
+
+    async def set(self, name, value):
+        await self.send({'method': 'set', 'name': name, 'value': value})
+
+    # only values with names starting with prefix are listed if given
+    async def list_values(self, prefix='', timeout=None):
+        future = asyncio.get_event_loop().create_future()
+        self.lists.append(future)
+        request = {'method': 'list'}
+        if prefix:
+            request['prefix'] = prefix
+        await self.send(request)
+        return await asyncio.wait_for(future, timeout)
+
+    # yield (name, value) for each update, names ending in * watch
+    # all values with that prefix, period limits the update rate
+    async def watch(self, name, period=0):
+        queue = asyncio.Queue()
+        first = not name in self.watches
+        self.watches.setdefault(name, []).append(queue)
+        if first:
+            request = {'method': 'watch', 'name': name, 'value': True}
+            if period:
+                request['period'] = period
+            if not name.endswith('*'): # server sends initial pattern values
+                await self.send({'method': 'get', 'name': name})
+            await self.send(request)
+        elif name in self.values:
+            queue.put_nowait((name, self.values[name]))
+
+        try:
+            while True:
+                msg = await queue.get()
+                if msg is None:
+                    return
+                yield msg
+        finally:
+            queues = self.watches[name]
+            queues.remove(queue)
+            if not queues:
+                del self.watches[name]
+                if not self.writer.is_closing():
+                    self.writer.write((pyjson.dumps({'method': 'watch', 'name': name, 'value': False}) + '\n').encode())
+
+# a connection to the async server, matching the interface
+# of LineBufferedNonBlockingSocket used by pypilotServer
+class AsyncSocket(object):
+    fd_count = 0
+    def __init__(self, server, writer):
+        self.server = server
+        self.socket = writer
+        AsyncSocket.fd_count += 1
+        self.fd = -AsyncSocket.fd_count # unique but not a real descriptor
+        self.out_buffer = ''
+        self.out_values = {}
+
+    def send(self, data):
+        self.out_buffer += data
+        self.server.ScheduleFlush()
+
+    def send_value(self, name, data):
+        self.out_values[name] = data
+        self.server.ScheduleFlush()
+
+    def flush(self):
+        if self.socket.is_closing():
+            return
+        # values keep coalescing while the client is backlogged
+        if self.socket.transport.get_write_buffer_size() > 65536:
+            return
+        if self.out_values:
+            self.out_buffer += ''.join(self.out_values.values())
+            self.out_values = {}
+        if self.out_buffer:
+            self.socket.write(self.out_buffer.encode())
+            self.out_buffer = ''
+
+class pypilotAsyncServer(pypilotServer):
+    def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path):
+        super(pypilotAsyncServer, self).__init__(port, persistent_path)
+        self.flush_scheduled = False
+        self.listeners = []
+
+    def ScheduleFlush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self.FlushSockets)
+
+    def FlushSockets(self):
+        self.flush_scheduled = False
+        self.snapshot = False
+        super(pypilotAsyncServer, self).FlushSockets()
+
+    def RemoveSocket(self, socket):
+        self.sockets.remove(socket)
+        socket.socket.close()
+        self.RemoveSocketWatches(socket)
+
+    async def HandleConnection(self, reader, writer):
+        if len(self.sockets) == max_connections:
+            print('pypilot server: max connections reached!!!', len(self.sockets))
+            self.RemoveSocket(self.sockets[0])
+
+        socket = AsyncSocket(self, writer)
+        self.sockets.append(socket)
+        self.socket_watches[socket] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip()
+                try:
+                    self.HandleRequest(socket, line)
+                except Exception as e:
+                    print('invalid request from socket', line, e)
+                    socket.send('invalid request: ' + line + '\n')
+        except (ConnectionError, ValueError): # reset or line too long
+            pass
+        if socket in self.sockets: # not already removed
+            self.RemoveSocket(socket)
+
+    async def Listen(self):
+        self.listeners.append(await asyncio.start_server(self.HandleConnection, '0.0.0.0', self.port))
+        if hasattr(socket, 'AF_UNIX'):
+            try:
+                unix_socket = BindUnixSocket(self.port)
+            except Exception as e: # clients still connect over tcp
+                print('pypilot_server: failed to listen on', UNIX_SOCKET_PATH % self.port, e)
+                return
+            self.listeners.append(await asyncio.start_unix_server(self.HandleConnection, sock=unix_socket))
+
+    # serve clients until cancelled, values registered before
+    # or during serving are updated by calling their set method
+    async def serve(self):
+        await self.Listen()
+        try:
+            while True:
+                await asyncio.sleep(self.PollTimeout(1))
+                if time.time() >= self.persistent_timeout:
+                    self.StorePersistentValues()
+                self.FlushSockets()
+        finally:
+            for listener in self.listeners:
+                listener.close()
+            for socket in list(self.sockets):
+                self.RemoveSocket(socket)
+            self.StorePersistentValues()
+
+if __name__ == '__main__':
+    from pypilot.values import Value, Property
+
+    async def main():
+        server = pypilotAsyncServer()
+        print('pypilot asyncio demo server, try running pypilot_client')
+        clock = server.Register(Value('clock', 0))
+        server.Register(Property('test', 1234))
+        task = asyncio.ensure_future(server.serve())
+        while True:
+            clock.set(clock.value + 1)
+            await asyncio.sleep(.02)
+
+    asyncio.get_event_loop().run_until_complete(main())
@@ -312,6 +312,9 @@ class Autopilot(object):
   def iteration(self):
       data = False
       t00 = time.time()
+      # apply steering commands ahead of everything else
+      self.server.HandleControlRequests()
+
       # set timestamp
       for tries in range(14): # try 14 times to read from imu 
           data = self.boatimu.IMURead()
@@ -392,6 +395,8 @@ class Autopilot(object):
 
 def main():
   ap = Autopilot()
+  if '-r' in sys.argv: # record imu samples while sailing for imu_replay
+    ap.boatimu.raw_log = open(sys.argv[sys.argv.index('-r') + 1], 'w')
   ap.run()
 
 if __name__ == '__main__':
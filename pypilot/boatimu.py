@@ -14,12 +14,14 @@
 
 from __future__ import print_function
 import os, sys
-import time, math, multiprocessing, select
+import time, math, multiprocessing, select, json
+import numpy
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import calibration_fit, vector, quaternion
 from pypilot.server import pypilotServer
 from pypilot.pipeserver import pypilotPipeServer, NonBlockingPipe
+from pypilot.ringbuffer import RingBufferPipe, RecordFormat
 from pypilot.values import *
 
 try:
@@ -28,6 +30,16 @@ except ImportError:
   RTIMU = False
   print('RTIMU library not detected, please install it')
 
+# fields of each imu sample sent from the imu process
+imu_record_fields = [('timestamp', 1), ('accel', 3), ('gyro', 3), ('compass', 3),
+                     ('fusionQPose', 4), ('accel.residuals', 3), ('gyrobias', 3),
+                     ('compass_calibration_updated', 0)]
+imu_record_format = RecordFormat(imu_record_fields)
+
+# records are sent at this rate, each the average of the samples since the last
+imu_record_rate = 25
+imu_averaged_fields = ['accel', 'gyro', 'compass', 'accel.residuals']
+
 def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
     if not RTIMU:
       while True:
@@ -99,6 +111,8 @@ def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
 
       avggyro = [0, 0, 0]
       compass_calibration_updated = False
+      decimation = max(int(round(1.0/(imu_record_rate*period))), 1)
+      samples = 0
 
       while True:
         t0 = time.time()
@@ -111,12 +125,26 @@ def imu_process(pipe, cal_pipe, accel_cal, compass_cal, gyrobias, period):
         data['accel.residuals'] = list(rtimu.getAccelResiduals())
         data['gyrobias'] = s.GyroBias
         #data['timestamp'] = t0 # imu timestamp is perfectly accurate
-        
-        if compass_calibration_updated:
-          data['compass_calibration_updated'] = True
-          compass_calibration_updated = False
 
-        pipe.send(data, False)
+        # average vectors over the record, other fields are the latest
+        if samples:
+          for name in imu_averaged_fields:
+            sums[name] = list(map(lambda x, y : x + y, sums[name], data[name]))
+        else:
+          sums = dict([(name, list(data[name])) for name in imu_averaged_fields])
+        samples += 1
+
+        if samples == decimation:
+          record = dict(data)
+          for name in imu_averaged_fields:
+            record[name] = list(map(lambda x : x / samples, sums[name]))
+          samples = 0
+
+          if compass_calibration_updated:
+            record['compass_calibration_updated'] = True
+            compass_calibration_updated = False
+
+          pipe.send(record, False)
 
         # see if gyro is out of range, sometimes the sensors read
         # very high gyro readings and the sensors need to be reset by software
@@ -169,19 +197,6 @@ class LoopFreqValue(Value):
             self.t0 = t1
             self.loopc = 0
 
-def readable_timespan(total):
-    mods = [('s', 1), ('m', 60), ('h', 60), ('d', 24), ('y', 365.24)]          
-    def loop(i, mod):
-        if i == len(mods) or (int(total / (mods[i][1]*mod)) == 0 and i > 0):
-            return ''
-        if i < len(mods) - 1:
-            div = mods[i][1]*mods[i+1][1]*mod
-            t = int(total%int(div))
-        else:
-            t = total
-        return loop(i+1, mods[i][1]*mod) + (('%d' + mods[i][0] + ' ') % (t/(mods[i][1]*mod)))
-    return loop(0, 1)
-
 class TimeValue(StringValue):
     def __init__(self, name, **kwargs):
         super(TimeValue, self).__init__(name, 0, **kwargs)
@@ -218,6 +233,9 @@ class TimeValue(StringValue):
             self.lastage_value = self.value
             self.lastage = readable_timespan(self.value)
         return '{"' + self.name + '": {"value": "' + self.lastage + '"}}'
+
+    def encoding(self):
+        return 'timespan'
       
 class AgeValue(StringValue):
     def __init__(self, name, **kwargs):
@@ -242,6 +260,9 @@ class AgeValue(StringValue):
             self.lastage = readable_timespan(dt)
         return '{"' + self.name + '": {"value": "' + self.lastage + '"}}'
 
+    def encoding(self):
+        return 'age'
+
 class QuaternionValue(ResettableValue):
     def __init__(self, name, initial, **kwargs):
       super(QuaternionValue, self).__init__(name, initial, **kwargs)
@@ -252,6 +273,27 @@ class QuaternionValue(ResettableValue):
       super(QuaternionValue, self).set(value)
 
 
+# all sensor values of one sample, so clients may watch a single
+# value instead of each sensor, fields are formatted like the sensors
+class FrameValue(Value):
+  def __init__(self, name, sensors, **kwargs):
+    self.fields = [(sensor, '"' + sensor + '": ', sensors[sensor].fmt) for sensor in sorted(sensors)]
+    super(FrameValue, self).__init__(name, False, **kwargs)
+
+  def type(self):
+    return 'FrameValue'
+
+  def encode_value(self, value):
+    if not value:
+      return 'false'
+    items = ['"timestamp": ' + format_value(value['timestamp'], '%.3f')]
+    for sensor, prefix, fmt in self.fields:
+      items.append(prefix + format_value(value[sensor], fmt))
+    return '{' + ', '.join(items) + '}'
+
+  def encoding(self):
+    return [('timestamp', '%.3f')] + [(sensor, fmt) for sensor, prefix, fmt in self.fields]
+
 class CalibrationProperty(RoundedValue):
   def __init__(self, name, server, default):
     self.default = default
@@ -269,28 +311,57 @@ class CalibrationProperty(RoundedValue):
       pass # startup before locked is initiated
     super(CalibrationProperty, self).set(value)
 
-def heading_filter(lp, a, b):
-    if not a:
-        return b
-    if not b:
-        return a
-    if a - b > 180:
-        a -= 360
-    elif b - a > 180:
-        b -= 360
-    result = lp*a + (1-lp)*b
-    if result < 0:
-        result += 360
-    return result
+# larger blocks of samples are derived with numpy
+max_scalar_block = 12
+
+# weights of the input samples and the initial value by filter constant and block size
+lowpass_weights = {}
+# the weights grow with the square of the size, so longer blocks are filtered in pieces
+max_lowpass_block = 64
+
+# first order lowpass y[n] = lp*x[n] + (1-lp)*y[n-1] over a block
+# of samples, continuing from y0 the filtered value before the block
+def lowpass_filter(lp, x, y0):
+    if len(x) > max_lowpass_block:
+        y = numpy.empty(len(x))
+        for i in range(0, len(x), max_lowpass_block):
+            y[i:i+max_lowpass_block] = lowpass_filter(lp, x[i:i+max_lowpass_block], y0)
+            y0 = y[min(i+max_lowpass_block, len(x))-1]
+        return y
+
+    key = lp, len(x)
+    if not key in lowpass_weights:
+        if len(lowpass_weights) > 256: # filter constants changed many times
+            lowpass_weights.clear()
+        k = numpy.arange(len(x))
+        d = k[:, None] - k[None, :]
+        lowpass_weights[key] = lp*numpy.where(d >= 0, (1-lp)**numpy.maximum(d, 0), 0), (1-lp)**(k+1)
+    w, w0 = lowpass_weights[key]
+    return w.dot(x) + w0*y0
+
+def heading_filter(lp, headings, y0):
+    if not y0:
+        y0 = headings[0]
+    # unwrap headings to be continuous starting near y0
+    steps = (differences(headings, y0) + 180) % 360 - 180
+    return lowpass_filter(lp, y0 + numpy.cumsum(steps), y0) % 360
+
+# differences of successive samples, the first from the previous value
+def differences(x, previous):
+    return x - numpy.concatenate(([previous], x[:-1]))
 
 class BoatIMU(object):
-  def __init__(self, server, *args, **keywords):
+  # without processes samples are only given to IMUProcess, eg for replay
+  def __init__(self, server, processes=True, *args, **keywords):
     self.starttime = time.time()
     self.server = server
+    self.raw_log = False # file to record each sample as a json line
 
     self.timestamp = server.Register(SensorValue('timestamp', 0))
+    # rate of the control loop, sensors are sampled faster and averaged
     self.rate = self.Register(EnumProperty, 'rate', 10, [10, 25], persistent=True)
     self.period = 1.0/self.rate.value
+    self.sample_rate = self.Register(EnumProperty, 'sample_rate', 100, [50, 100], persistent=True)
 
     self.loopfreq = self.Register(LoopFreqValue, 'loopfreq', 0)
     self.alignmentQ = self.Register(QuaternionValue, 'alignmentQ', [2**.5/2, -2**.5/2, 0, 0], persistent=True)
@@ -315,13 +386,7 @@ class BoatIMU(object):
     self.accel_calibration = RegisterCalibration('accel', [[0, 0, 0, 1], 1])
     self.compass_calibration = RegisterCalibration('compass', [[0, 0, 0, 30, 0], [1, 1], 0])
     
-    self.imu_pipe, imu_pipe = NonBlockingPipe('imu_pipe')
-    imu_cal_pipe, self.imu_cal_pipe = NonBlockingPipe('imu_cal_pipe')
-
-    self.poller = select.poll()
-    self.poller.register(self.imu_pipe, select.POLLIN)
-
-    self.auto_cal = calibration_fit.IMUAutomaticCalibration()
+    self.auto_cal = calibration_fit.IMUAutomaticCalibration() if processes else False
 
     self.lasttimestamp = 0
 
@@ -347,18 +412,31 @@ class BoatIMU(object):
     sensornames += ['gyrobias']
     self.SensorValues['gyrobias'] = self.Register(SensorValue, 'gyrobias', persistent=True)
 
-    self.imu_process = multiprocessing.Process(target=imu_process, args=(imu_pipe,imu_cal_pipe, self.accel_calibration.value[0], self.compass_calibration.value[0], self.SensorValues['gyrobias'].value, self.period))
-    self.imu_process.start()
+    # only computed while watched
+    self.frame = self.Register(FrameValue, 'frame', self.SensorValues)
+
+    self.imu_pipe = self.imu_process = False
+    if processes:
+      self.imu_pipe, imu_pipe = RingBufferPipe('imu_pipe', imu_record_fields)
+      imu_cal_pipe, self.imu_cal_pipe = NonBlockingPipe('imu_cal_pipe')
+      self.imu_process = multiprocessing.Process(target=imu_process, args=(imu_pipe,imu_cal_pipe, self.accel_calibration.value[0], self.compass_calibration.value[0], self.SensorValues['gyrobias'].value, 1.0/self.sample_rate.value))
+      self.imu_process.start()
 
     self.last_imuread = time.time()
 
   def __del__(self):
-    print('terminate imu process')
-    self.imu_process.terminate()
+    if self.imu_process:
+      print('terminate imu process')
+      self.imu_process.terminate()
 
   def Register(self, _type, name, *args, **kwargs):
     value = _type(*(['imu.' + name] + list(args)), **kwargs)
     return self.server.Register(value)
+
+  # filter constants are given per control loop at imu.rate, records
+  # arrive faster so each is filtered less for the same response
+  def record_lowpass(self, lp):
+    return 1 - (1 - lp)**(float(self.rate.value)/imu_record_rate)
       
   def update_alignment(self, q):
     a2 = 2*math.atan2(q[3], q[0])
@@ -367,24 +445,35 @@ class BoatIMU(object):
     o = quaternion.angvec2quat(off*math.pi/180, [0, 0, 1])
     self.alignmentQ.update(quaternion.normalize(quaternion.multiply(q, o)))
 
-  def IMURead(self):    
-    data = False
+  def IMURead(self):
+    samples = self.imu_pipe.recv_array() # every sample queued since the last read
 
-    while self.poller.poll(0): # read all the data from the pipe
-      data = self.imu_pipe.recv()
-
-    if not data:
+    if not len(samples):
       if time.time() - self.last_imuread > 1 and self.loopfreq.value:
         print('IMURead failed!')
         self.loopfreq.set(0)
         for name in self.SensorValues:
           self.SensorValues[name].set(False)
+        self.frame.set(False)
         self.uptime.reset()
       return False
-  
-    if vector.norm(data['accel']) == 0:
-      print('accel values invalid', data['accel'])
+
+    if self.raw_log:
+      for record in imu_record_format.to_dicts(samples):
+        self.raw_log.write(json.dumps(record) + '\n')
+
+    return self.IMUProcess(samples)
+
+  # derive and filter a block of samples in order, sensor values
+  # are set from the last sample which is returned as a dict
+  def IMUProcess(self, samples):
+    if len(samples) > max_scalar_block:
+      derived = self.DeriveBlock(samples)
+    else:
+      derived = self.DeriveSamples(samples)
+    if not derived:
       return False
+    data, poses, origfusionQPose = derived
 
     t = time.time()
     self.timestamp.set(t-self.starttime)
@@ -392,49 +481,16 @@ class BoatIMU(object):
     self.last_imuread = t
     self.loopfreq.strobe()
 
-    # apply alignment calibration
-    gyro_q = quaternion.rotvecquat(data['gyro'], data['fusionQPose'])
-
-    data['pitchrate'], data['rollrate'], data['headingrate'] = map(math.degrees, gyro_q)
-    origfusionQPose = data['fusionQPose']
-    
-    aligned = quaternion.multiply(data['fusionQPose'], self.alignmentQ.value)
-    data['fusionQPose'] = quaternion.normalize(aligned) # floating point precision errors
-
-    data['roll'], data['pitch'], data['heading'] = map(math.degrees, quaternion.toeuler(data['fusionQPose']))
-
-    if data['heading'] < 0:
-      data['heading'] += 360
-
-    dt = data['timestamp'] - self.lasttimestamp
-    self.lasttimestamp = data['timestamp']
-    if dt > .02 and dt < .5:
-      data['headingraterate'] = (data['headingrate'] - self.headingrate) / dt
-    else:
-      data['headingraterate'] = 0
-
-    self.headingrate = data['headingrate']
-
-    data['heel'] = self.heel = data['roll']*.03 + self.heel*.97
-    #data['roll'] -= data['heel']
-
-    data['gyro'] = list(map(math.degrees, data['gyro']))
-    data['gyrobias'] = list(map(math.degrees, data['gyrobias']))
-
-    # lowpass heading and rate
-    llp = self.heading_lowpass_constant.value
-    data['heading_lowpass'] = heading_filter(llp, data['heading'], self.SensorValues['heading_lowpass'].value)
-
-    llp = self.headingrate_lowpass_constant.value
-    data['headingrate_lowpass'] = llp*data['headingrate'] + (1-llp)*self.SensorValues['headingrate_lowpass'].value
-
-    llp = self.headingraterate_lowpass_constant.value
-    data['headingraterate_lowpass'] = llp*data['headingraterate'] + (1-llp)*self.SensorValues['headingraterate_lowpass'].value
-
     # set sensors
     for name in self.SensorValues:
       self.SensorValues[name].set(data[name])
 
+    if self.frame.watchers or self.frame.periodic_watchers:
+      frame = {'timestamp': self.timestamp.value}
+      for name in self.SensorValues:
+        frame[name] = data[name]
+      self.frame.set(frame)
+
     self.uptime.update()
 
     # count down to alignment
@@ -442,7 +498,8 @@ class BoatIMU(object):
       self.alignmentPose = [0, 0, 0, 0]
 
     if self.alignmentCounter.value > 0:
-      self.alignmentPose = list(map(lambda x, y : x + y, self.alignmentPose, data['fusionQPose']))
+      # average every sample of the block
+      self.alignmentPose = (numpy.sum(poses, axis=0) + self.alignmentPose).tolist()
       self.alignmentCounter.set(self.alignmentCounter.value-1)
 
       if self.alignmentCounter.value == 0:
@@ -470,13 +527,141 @@ class BoatIMU(object):
       cal_data['compass'] = list(data['compass'])
       cal_data['down'] = quaternion.rotvecquat([0, 0, 1], quaternion.conjugate(origfusionQPose))
 
-    if cal_data:
+    if cal_data and self.auto_cal:
       self.auto_cal.cal_pipe.send(cal_data)
 
     self.accel_calibration.age.update()
     self.compass_calibration.age.update()
     return data
 
+  # for small blocks numpy calls would cost more than the math, so
+  # each sample is filtered in turn, and only the last fully derived
+  def DeriveSamples(self, samples):
+    index = imu_record_format.index
+    records = []
+    for values in imu_record_format.to_tuples(samples):
+      if any(values[index['accel']]):
+        records.append(values)
+      else:
+        print('accel values invalid', values[index['accel']])
+    if not records:
+      return False
+    itimestamp, igyro, iq = index['timestamp'], index['gyro'], index['fusionQPose']
+
+    heading_lowpass = self.SensorValues['heading_lowpass'].value
+    headingrate_lowpass = self.SensorValues['headingrate_lowpass'].value or 0
+    headingraterate_lowpass = self.SensorValues['headingraterate_lowpass'].value or 0
+    heel_lp = self.record_lowpass(.03)
+    heading_llp = self.record_lowpass(self.heading_lowpass_constant.value)
+    headingrate_llp = self.record_lowpass(self.headingrate_lowpass_constant.value)
+    headingraterate_llp = self.record_lowpass(self.headingraterate_lowpass_constant.value)
+    unwrapped = last_heading = False
+
+    poses = []
+    for values in records:
+      # apply alignment calibration
+      q = values[iq]
+      pitchrate, rollrate, headingrate = map(math.degrees, quaternion.rotvecquat(values[igyro], q))
+      aligned = quaternion.multiply(q, self.alignmentQ.value)
+      fusionQPose = quaternion.normalize(aligned) # floating point precision errors
+      poses.append(fusionQPose)
+
+      roll, pitch, heading = map(math.degrees, quaternion.toeuler(fusionQPose))
+      if heading < 0:
+        heading += 360
+
+      timestamp = values[itimestamp]
+      dt = timestamp - self.lasttimestamp
+      self.lasttimestamp = timestamp
+      if dt > .02 and dt < .5:
+        headingraterate = (headingrate - self.headingrate) / dt
+      else:
+        headingraterate = 0
+      self.headingrate = headingrate
+
+      self.heel = roll*heel_lp + self.heel*(1-heel_lp)
+      #roll -= self.heel
+
+      # lowpass heading and rate, unwrapped like heading_filter
+      if unwrapped is False:
+        if not heading_lowpass:
+          heading_lowpass = heading
+        unwrapped = last_heading = heading_lowpass
+      unwrapped += (heading - last_heading + 180) % 360 - 180
+      last_heading = heading
+      heading_lowpass = heading_llp*unwrapped + (1-heading_llp)*heading_lowpass
+
+      headingrate_lowpass = headingrate_llp*headingrate + (1-headingrate_llp)*headingrate_lowpass
+      headingraterate_lowpass = headingraterate_llp*headingraterate + (1-headingraterate_llp)*headingraterate_lowpass
+
+    data = {'timestamp': timestamp, 'accel': list(values[index['accel']]),
+            'compass': list(values[index['compass']]), 'accel.residuals': list(values[index['accel.residuals']]),
+            'gyro': list(map(math.degrees, values[igyro])), 'gyrobias': list(map(math.degrees, values[index['gyrobias']])),
+            'fusionQPose': fusionQPose, 'pitchrate': pitchrate, 'rollrate': rollrate,
+            'headingrate': headingrate, 'headingraterate': headingraterate,
+            'roll': roll, 'pitch': pitch, 'heading': heading, 'heel': self.heel,
+            'heading_lowpass': heading_lowpass % 360, 'headingrate_lowpass': headingrate_lowpass,
+            'headingraterate_lowpass': headingraterate_lowpass}
+    for values in records:
+      if values[index['compass_calibration_updated']]:
+        data['compass_calibration_updated'] = True
+    return data, poses, list(q)
+
+  # derive a block of samples at once with numpy
+  def DeriveBlock(self, samples):
+    valid = numpy.any(samples['accel'] != 0, axis=1)
+    if not valid.all():
+      print('accel values invalid', samples['accel'][~valid][0].tolist())
+      samples = samples[valid]
+      if not len(samples):
+        return False
+
+    # apply alignment calibration
+    q = samples['fusionQPose']
+    rates = numpy.degrees(quaternion.rotvecquat_batch(samples['gyro'], q))
+    pitchrate, rollrate, headingrate = rates[:, 0], rates[:, 1], rates[:, 2]
+
+    aligned = quaternion.multiply_batch(q, self.alignmentQ.value)
+    fusionQPose = quaternion.normalize_batch(aligned) # floating point precision errors
+
+    roll, pitch, heading = map(numpy.degrees, quaternion.toeuler_batch(fusionQPose))
+    heading = numpy.where(heading < 0, heading + 360, heading)
+
+    timestamp = samples['timestamp']
+    dt = differences(timestamp, self.lasttimestamp)
+    ddt = (dt > .02) & (dt < .5)
+    headingraterate = numpy.where(ddt, differences(headingrate, self.headingrate) / numpy.where(ddt, dt, 1), 0)
+    self.lasttimestamp = float(timestamp[-1])
+    self.headingrate = float(headingrate[-1])
+
+    heel = lowpass_filter(self.record_lowpass(.03), roll, self.heel)
+    self.heel = float(heel[-1])
+    #roll -= heel
+
+    # lowpass heading and rate
+    llp = self.record_lowpass(self.heading_lowpass_constant.value)
+    heading_lowpass = heading_filter(llp, heading, self.SensorValues['heading_lowpass'].value)
+
+    llp = self.record_lowpass(self.headingrate_lowpass_constant.value)
+    headingrate_lowpass = lowpass_filter(llp, headingrate, self.SensorValues['headingrate_lowpass'].value or 0)
+
+    llp = self.record_lowpass(self.headingraterate_lowpass_constant.value)
+    headingraterate_lowpass = lowpass_filter(llp, headingraterate, self.SensorValues['headingraterate_lowpass'].value or 0)
+
+    data = {}
+    for name, values in [('timestamp', timestamp), ('accel', samples['accel']),
+                         ('compass', samples['compass']), ('accel.residuals', samples['accel.residuals']),
+                         ('gyro', numpy.degrees(samples['gyro'])), ('gyrobias', numpy.degrees(samples['gyrobias'])),
+                         ('fusionQPose', fusionQPose), ('pitchrate', pitchrate), ('rollrate', rollrate),
+                         ('headingrate', headingrate), ('headingraterate', headingraterate),
+                         ('roll', roll), ('pitch', pitch), ('heading', heading), ('heel', heel),
+                         ('heading_lowpass', heading_lowpass), ('headingrate_lowpass', headingrate_lowpass),
+                         ('headingraterate_lowpass', headingraterate_lowpass)]:
+      data[name] = values[-1].tolist()
+    if samples['compass_calibration_updated'].any():
+      data['compass_calibration_updated'] = True
+    return data, fusionQPose, q[-1].tolist()
+
 class BoatIMUServer():
   def __init__(self):
     # setup all processes to exit on any signal
@@ -529,6 +714,8 @@ class BoatIMUServer():
 def main():
   boatimu = BoatIMUServer()
   quiet = '-q' in sys.argv
+  if '-r' in sys.argv: # record samples for imu_replay
+    boatimu.boatimu.raw_log = open(sys.argv[sys.argv.index('-r') + 1], 'w')
 
   while True:
     boatimu.iteration()
@@ -8,7 +8,7 @@
 # version 3 of the License, or (at your option) any later version.  
 
 from __future__ import print_function
-import time, select
+import time, select, codecs
 
 try:
   from pypilot.linebuffer import linebuffer
@@ -22,7 +22,9 @@ try:
         self.b = linebuffer.LineBuffer(connection.fileno())
 
         self.socket = connection
+        self.fd = connection.fileno()
         self.out_buffer = ''
+        self.out_values = {} # newest unsent data for each watched value
         self.pollout = select.poll()
         self.pollout.register(connection, select.POLLOUT)
         self.sendfail_msg = 1
@@ -34,15 +36,32 @@ try:
     def readline(self):
         return self.b.line()
 
+    # all complete lines in the buffer
+    def readlines(self):
+        lines = []
+        while True:
+            line = self.b.line()
+            if not line:
+                return lines
+            lines.append(line)
+
     def send(self, data):
         self.out_buffer += data
         if len(self.out_buffer) > 65536:
             print('overflow in pypilot socket')
             self.socket.close()
+
+    # value updates are coalesced so a backlogged client
+    # only receives the newest data for each value
+    def send_value(self, name, data):
+        self.out_values[name] = data
     
     def flush(self):
         if not self.out_buffer:
-            return
+            if not self.out_values:
+                return
+            self.out_buffer = ''.join(self.out_values.values())
+            self.out_values = {}
         try:
             if not self.pollout.poll(0):
                 if self.sendfail_cnt >= self.sendfail_msg:
@@ -63,6 +82,9 @@ try:
                 print('socket send error', count)
                 self.socket.close()
             self.out_buffer = self.out_buffer[count:]
+            # only consecutive failures close a slow client
+            self.sendfail_cnt = 0
+            self.sendfail_msg = 1
         except Exception as e:
             print('pypilot socket exception', e)
             self.socket.close()
@@ -72,16 +94,26 @@ except Exception as e:
     def __init__(self, connection):
         connection.setblocking(0)
         self.socket = connection
+        self.fd = connection.fileno()
         self.in_buffer = ''
+        # characters may be split between reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
         self.no_newline_pos = 0
         self.out_buffer = ''
+        self.out_values = {}
 
     def send(self, data):
         self.out_buffer += data
 
+    def send_value(self, name, data):
+        self.out_values[name] = data
+
     def flush(self):
         if not len(self.out_buffer):
-            return
+            if not self.out_values:
+                return
+            self.out_buffer = ''.join(self.out_values.values())
+            self.out_values = {}
         try:
             count = self.socket.send(self.out_buffer.encode())
             if count < 0:
@@ -103,18 +135,27 @@ except Exception as e:
         if l == 0:
             return False
 
-        self.in_buffer += data
+        self.in_buffer += self.decoder.decode(data)
         if l == size:
             return l+self.recv()
         return l
 
     def readline(self):
-        while self.no_newline_pos < len(self.in_buffer):
-            c = self.in_buffer[self.no_newline_pos]
-            if c=='\n':
-                ret = self.in_buffer[:self.no_newline_pos]
-                self.in_buffer = self.in_buffer[self.no_newline_pos+1:]
-                self.no_newline_pos = 0
-                return ret
-            self.no_newline_pos += 1
-        return ''
+        pos = self.in_buffer.find('\n', self.no_newline_pos)
+        if pos < 0:
+            self.no_newline_pos = len(self.in_buffer)
+            return ''
+        ret = self.in_buffer[:pos]
+        self.in_buffer = self.in_buffer[pos+1:]
+        self.no_newline_pos = 0
+        return ret
+
+    def readlines(self):
+        pos = self.in_buffer.rfind('\n', self.no_newline_pos)
+        if pos < 0:
+            self.no_newline_pos = len(self.in_buffer)
+            return []
+        lines = self.in_buffer[:pos].split('\n')
+        self.in_buffer = self.in_buffer[pos+1:]
+        self.no_newline_pos = 0
+        return lines
@@ -10,6 +10,7 @@
 from __future__ import print_function
 import sys, time, multiprocessing, math, numpy
 import vector, resolv, quaternion
+resolv_batch = resolv.resolv_batch
 resolv = resolv.resolv
 
 from pypilot.pipeserver import NonBlockingPipe
@@ -451,24 +452,17 @@ class SigmaPoints(object):
 # calculate how well these datapoints cover the space by
 # counting how many 20 degree segments have at least 1 datapoint
 def ComputeCoverage(p, bias, norm):
+    p = numpy.array(p)
     q = quaternion.vec2vec2quat(norm, [0, 0, 1])
-    def ang(p):
-        c = quaternion.rotvecquat(vector.sub(p[:3], bias), q)
-        d = quaternion.rotvecquat(p[3:6], q)
-        v = quaternion.rotvecquat(c, quaternion.vec2vec2quat(d, [0, 0, 1]))
-        v = vector.normalize(v)
-        return math.degrees(math.atan2(v[1], v[0]))
+    c = quaternion.rotvecquat_batch(p[:, :3] - bias, q)
+    d = quaternion.rotvecquat_batch(p[:, 3:6], q)
+    v = quaternion.rotvecquat_batch(c, quaternion.vec2vec2quat_batch(d, [0, 0, 1]))
+    a = numpy.degrees(numpy.arctan2(v[:, 1], v[:, 0]))
     #, abs(math.degrees(math.acos(v[2])))
 
     spacing = 20 # 20 degree segments
-    angles = [False] * int(360 / spacing)
-    count = 0
-    for a in lmap(ang, p):
-        i = int(resolv(a, 180) / spacing)
-        if not angles[i]:
-            angles[i] = True
-            count += 1
-    return count
+    segments = (resolv_batch(a, 180) / spacing).astype(int) % int(360 / spacing)
+    return len(numpy.unique(segments))
 
 def FitAccel(debug, accel_cal):
     p = accel_cal.Points()
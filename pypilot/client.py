@@ -10,8 +10,11 @@
 from __future__ import print_function
 
 import socket, select, sys, os, time, json
+from collections import deque
 
 from pypilot.bufferedsocket import LineBufferedNonBlockingSocket
+from pypilot import pyjson
+from pypilot.localsocket import UNIX_SOCKET_PATH
 
 DEFAULT_PORT = 21311
 
@@ -35,9 +38,33 @@ except:
 class ConnectionLost(Exception):
     pass
 
+# seconds between reconnect attempts, doubled after each failure
+reconnect_delay_min = .5
+reconnect_delay_max = 16
+
+# connect to a pypilot server, local servers are reached through
+# their unix domain socket if available, otherwise tcp is used
+def pypilotConnection(host, port, timeout=1):
+    if host in ['localhost', '127.0.0.1'] and hasattr(socket, 'AF_UNIX'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(UNIX_SOCKET_PATH % port)
+            return connection
+        except Exception:
+            connection.close()
+
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    connection.connect((host, port))
+    return connection
+
 class pypilotClient(object):
     def __init__(self, f_on_connected, host=False, port=False, autoreconnect=False, have_watches=False):
         self.autoreconnect = autoreconnect
+        self.connected = False
+        self.watches = {} # period of each active watch, replayed on reconnect
+        self.pending_sets = {} # requests set while disconnected
+        self.reconnect_delay = reconnect_delay_min
 
         config = {}
         try:
@@ -92,10 +119,7 @@ class pypilotClient(object):
                 else:
                     port = DEFAULT_PORT
             try:
-                #connection = socket.create_connection((host, port), 1)
-                connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                connection.settimeout(1)
-                connection.connect((host, port))
+                connection = pypilotConnection(host, port)
             except:
                 print('connect failed to %s:%d' % (host, port))
                 raise
@@ -119,7 +143,7 @@ class pypilotClient(object):
 
         self.socket = LineBufferedNonBlockingSocket(connection)
         self.values = []
-        self.msg_queue = []
+        self.msg_queue = deque()
         self.poller = select.poll()
         #if self.socket:
         #    fd = self.socket.socket.fileno()
@@ -127,11 +151,25 @@ class pypilotClient(object):
         #    fd = self.serial.fileno()
         #self.poller.register(fd, select.POLLIN)
         self.poller.register(self.socket.socket, select.POLLIN)
+        self.connected = True
+        self.reconnect_delay = reconnect_delay_min
 
-        
+        # replay watches the callback does not make again
+        watches, self.watches = self.watches, {}
         self.f_on_connected(self)
+        for name in watches:
+            if not name in self.watches:
+                self.watch(name, True, watches[name])
+
+        for request in self.pending_sets.values():
+            self.socket.send(request)
+        self.pending_sets = {}
 
     def poll(self, timeout = 0):        
+        if not self.connected:
+            self.reconnect(timeout)
+            return False
+
         t0 = time.time()
         self.socket.flush()
         events = self.poller.poll(int(1000 * timeout))
@@ -146,48 +184,96 @@ class pypilotClient(object):
                 return True
         return False
 
+    # requests other than sets and watches are dropped while disconnected
     def send(self, request):
-        self.socket.send(json.dumps(request)+'\n')
+        if self.connected:
+            self.socket.send(pyjson.dumps(request)+'\n')
 
-    def receive_line(self, timeout = 0):
-        line = self.socket.readline()
-        if line:
-            try:
-                msg = json.loads(line.rstrip())
-            except:
-                raise Exception('invalid message from server:', line)
-            return msg
-
-        if timeout < 0:
+    def decode_line(self, line):
+        try:
+            return pyjson.loads(line.rstrip())
+        except:
+            raise Exception('invalid message from server:', line)
+
+    # poll for the time remaining from t0, at least once unless timeout
+    # is negative, returns False once there is nothing more to wait for
+    def poll_receive(self, timeout, t0, polled):
+        remaining = timeout - (time.time() - t0)
+        if timeout < 0 or (polled and remaining <= 0):
             return False
-
-        t = time.time()
         try:
-            if not self.poll(timeout):
-                return False
+            return self.poll(max(remaining, 0))
         except Exception as e:
             print('exception', e)
             self.disconnected()
-        dt = time.time()-t
-        return self.receive_line(timeout - dt)
+            return False
+
+    def receive_line(self, timeout = 0):
+        t0 = time.time()
+        polled = False
+        while True:
+            line = self.socket.readline()
+            if line:
+                return self.decode_line(line)
+            if not self.poll_receive(timeout, t0, polled):
+                return False
+            polled = True
+
+    # decode every complete line in the buffer into the message queue, a
+    # line that fails to decode is raised once the lines after it are queued
+    def receive_lines(self):
+        error = False
+        for line in self.socket.readlines():
+            try:
+                self.msg_queue.extend(self.flatten_line(self.decode_line(line)))
+            except Exception as e:
+                error = e
+        if error:
+            raise error
+        return len(self.msg_queue)
+
+    # yield (name, value) for each message until timeout elapses
+    # with nothing queued, a timeout of 0 yields what is available
+    def messages(self, timeout = 0):
+        t0 = time.time()
+        polled = False
+        while True:
+            while self.msg_queue:
+                yield self.msg_queue.popleft()
+            if self.receive_lines():
+                continue
+            if not self.poll_receive(timeout, t0, polled):
+                return
+            polled = True
 
     def disconnected(self):
         self.socket.socket.close()
         if not self.autoreconnect:
             raise ConnectionLost
-                
-        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        while True:
-            print('Disconnected.  Reconnecting in 3...')
-            time.sleep(3)
-            try:
-                connection.connect(self.host_port)
-                print('Connected.')
-                break
-            except:
-                continue
 
+        self.connected = False
+        self.reconnect_time = time.time() + self.reconnect_delay
+        print('Disconnected.  Reconnecting in %.1f...' % self.reconnect_delay)
+
+    # attempt to connect again waiting at most timeout, so the
+    # caller can service its own io while the server is down
+    def reconnect(self, timeout = 0):
+        dt = self.reconnect_time - time.time()
+        if dt > 0:
+            time.sleep(max(min(dt, timeout), 0))
+            if dt > timeout:
+                return False
+
+        try:
+            connection = pypilotConnection(*self.host_port, timeout=.5)
+        except Exception:
+            self.reconnect_delay = min(2*self.reconnect_delay, reconnect_delay_max)
+            self.reconnect_time = time.time() + self.reconnect_delay
+            return False
+
+        print('Connected.')
         self.onconnected(connection)
+        return True
 
     def receive(self, timeout = 0):
         ret = {}
@@ -199,16 +285,15 @@ class pypilotClient(object):
         return ret
 
     def receive_single(self, timeout = 0):
-        if len(self.msg_queue) > 0:
-            msg = self.msg_queue[0]
-            self.msg_queue = self.msg_queue[1:]
-            return msg
-        
-        line = self.receive_line(timeout)
-        if line:
-            self.msg_queue += self.flatten_line(line)
-            return self.receive_single(-1)
-        return False
+        t0 = time.time()
+        polled = False
+        while not self.msg_queue:
+            if self.receive_lines():
+                break
+            if not self.poll_receive(timeout, t0, polled):
+                return False
+            polled = True
+        return self.msg_queue.popleft()
 
     def flatten_line(self, line, name_prefix=''):
         msgs = []
@@ -221,8 +306,11 @@ class pypilotClient(object):
                     msgs += self.flatten_line(msg, name_prefix + name + '/')
         return msgs
 
-    def list_values(self, timeout=10):
+    # only values with names starting with prefix are listed if given
+    def list_values(self, timeout=10, prefix=''):
         request = {'method' : 'list'}
+        if prefix:
+            request['prefix'] = prefix
         self.send(request)
         
         t0 = t = time.time()
@@ -238,20 +326,54 @@ class pypilotClient(object):
         request = {'method' : 'get', 'name' : name}
         self.send(request)
 
+    def get_many(self, names):
+        self.send({'method' : 'get_many', 'names' : list(names)})
+
+    # request every value in a single message
+    def snapshot(self):
+        self.send({'method' : 'snapshot'})
+
     def set(self, name, value):
         # quote strings
         if type(value) == type('') or type(value) == type(u''):
-            value = '"' + value + '"'
+            value = pyjson.dumps(value)
         elif type(value) == type(True):
             value = 'true' if value else 'false'
                                         
         request = '{"method": "set", "name": "' + name + '", "value": ' + str(value) + '}\n'
-        self.socket.send(request)
-
-    def watch(self, name, value=True):
+        if self.connected:
+            self.socket.send(request)
+        else: # only the latest set of each value is sent on reconnect
+            self.pending_sets[name] = request
+
+    # period limits updates to at most one per period (seconds)
+    # names ending in * such as imu.* watch all values with that prefix
+    def watch(self, name, value=True, period=0):
         if value:
+            self.watches[name] = period
+        elif name in self.watches:
+            del self.watches[name]
+
+        if value and not name.endswith('*'): # server sends initial pattern values
             self.get(name)
-        self.send({'method' : 'watch', 'name' : name, 'value' : value})
+        request = {'method' : 'watch', 'name' : name, 'value' : value}
+        if period:
+            request['period'] = period
+        self.send(request)
+
+    def watch_many(self, names, value=True, period=0):
+        for name in names:
+            if value:
+                self.watches[name] = period
+            elif name in self.watches:
+                del self.watches[name]
+
+        if value:
+            self.get_many(names)
+        request = {'method' : 'watch_many', 'names' : list(names), 'value' : value}
+        if period:
+            request['period'] = period
+        self.send(request)
 
     def print_values(self, timeout, info=False):
         t0 = time.time()
@@ -260,27 +382,14 @@ class pypilotClient(object):
             if not self.values:
                 return False
 
-        names = sorted(self.values)
-            
-        count = 0
+        self.snapshot()
         results = {}
-        while count < len(self.values):
-            if names:
-                self.get(names.pop())
-            else:
-                time.sleep(.1)
-
+        while len(results) < len(self.values):
             if time.time()-t0 >= timeout:
                 return False
-            while True:
-                msg = self.receive_single()
-                if not msg:
-                    break
+            msg = self.receive_single(.1)
+            if msg:
                 name, value = msg
-                if name in results:
-                    break
-                count+=1
-                
                 results[name] = value
 
         for name in sorted(results):
@@ -294,6 +403,89 @@ class pypilotClient(object):
                 print(name, '=', result)
         return True
 
+# types of values converted on update, others are kept as decoded
+client_value_types = {'BooleanProperty': bool, 'BooleanValue': bool,
+                      'RangeProperty': float, 'RangeSetting': float}
+
+# attribute access to the values below a name prefix
+class ClientValuesPrefix(object):
+    def __init__(self, values, prefix):
+        self._values = values
+        self._prefix = prefix
+
+    def __getattr__(self, attr):
+        return self._values.lookup(self._prefix + attr)
+
+# mirror of the values received by a client, update applies messages in
+# bulk and calls the callbacks registered for each name that changed
+#
+#   values = ClientValues(client.list_values())
+#   values.register('ap.heading', f)
+#   values.update(client.messages())
+#   values['ap.heading'], values.ap.heading
+class ClientValues(object):
+    def __init__(self, info={}):
+        self.info = dict(info) # type information by name from list_values
+        self.values = {}
+        self.callbacks = {}
+
+    def register(self, name, callback):
+        if not name in self.callbacks:
+            self.callbacks[name] = []
+        self.callbacks[name].append(callback)
+
+    # accepts a dict or (name, data) pairs as returned by the client
+    def update(self, msgs):
+        if type(msgs) == type({}):
+            msgs = msgs.items()
+
+        changed = []
+        for name, data in msgs:
+            if not 'value' in data: # type information
+                self.info[name] = data
+                continue
+            value = data['value']
+            if name in self.info and self.info[name].get('type') in client_value_types:
+                value = client_value_types[self.info[name]['type']](value)
+            if name in self.values and self.values[name] == value:
+                continue
+            self.values[name] = value
+            changed.append(name)
+
+        for name in changed:
+            if name in self.callbacks:
+                for callback in self.callbacks[name]:
+                    callback(name, self.values[name])
+        return changed
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        self.values[name] = value
+
+    def __contains__(self, name):
+        return name in self.values
+
+    # a value takes precedence over a prefix, so values.imu.compass
+    # is imu.compass and imu.compass.calibration needs values[name]
+    def lookup(self, name):
+        if name in self.values:
+            return self.values[name]
+        prefix = name + '.'
+        for n in list(self.values) + list(self.info):
+            if n.startswith(prefix):
+                return ClientValuesPrefix(self, prefix)
+        raise AttributeError(name)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or attr in ['info', 'values', 'callbacks']:
+            raise AttributeError(attr)
+        return self.lookup(attr)
+
 def pypilotClientFromArgs(argv, watch, f_con=False):
     host = port = False
     watches = argv[1:]
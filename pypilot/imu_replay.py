@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# replay recorded imu samples through the same processing as BoatIMU
+# without sensors or realtime delays, to tune filter constants offline
+#
+# samples are json dicts one per line as recorded while the
+# autopilot runs with: pypilot -r FILE, or by: boatimu.py -r FILE
+
+from __future__ import print_function
+import sys, time, json, numbers
+
+from pypilot.boatimu import BoatIMU, imu_record_format
+from pypilot.server import LoadPersistentData, default_persistent_path
+
+# holds the registered values without serving them, persistent
+# values such as the alignment start as saved on the boat
+class ReplayServer(object):
+    def __init__(self, persistent_data={}):
+        self.values = {}
+        self.persistent_data = persistent_data
+
+    def Register(self, value):
+        if value.persistent and value.name in self.persistent_data:
+            v = self.persistent_data[value.name]
+            if isinstance(v, numbers.Number):
+                v = float(v) # convert any numeric to floating point
+            value.set(v)
+        self.values[value.name] = value
+        return value
+
+def load_samples(filename):
+    records = []
+    f = open(filename)
+    for line in f:
+        line = line.strip()
+        if line:
+            records.append(json.loads(line))
+    f.close()
+    return imu_record_format.to_array(records)
+
+# settings are applied to values by name, eg {'imu.heading_lowpass_constant': .2}
+# block is the number of samples processed in each call like queued samples
+# f is called with the resulting data of each block, returns samples/sec
+def replay(samples, settings={}, block=1, f=False, persistent_data={}):
+    server = ReplayServer(persistent_data)
+    imu = BoatIMU(server, processes=False)
+    for name in settings:
+        server.values[name].set(settings[name])
+
+    t0 = time.time()
+    for i in range(0, len(samples), block):
+        data = imu.IMUProcess(samples[i:i+block])
+        if data and f:
+            f(data)
+    return len(samples) / max(time.time() - t0, 1e-9)
+
+def main():
+    if len(sys.argv) < 2 or '-h' in sys.argv:
+        print('usage', sys.argv[0], 'FILE [-b BLOCK] [-o OUTPUT] [-p CONFIG] [-s NAME=VALUE]...')
+        print('eg:', sys.argv[0], 'imu.log -s imu.heading_lowpass_constant=.2 -o out.log')
+        print('-b', 'samples processed together, default 1')
+        print('-o', 'write the resulting data of each block as json lines')
+        print('-p', 'persistent values saved by the autopilot, default', default_persistent_path)
+        print('-s', 'set a value before replaying, eg imu.alignmentQ=[1,0,0,0]')
+        exit(0)
+
+    args = sys.argv[2:]
+    block, output, settings = 1, False, {}
+    persistent_path = default_persistent_path
+    while args:
+        arg = args.pop(0)
+        if arg == '-b':
+            block = int(args.pop(0))
+        elif arg == '-o':
+            output = open(args.pop(0), 'w')
+        elif arg == '-p':
+            persistent_path = args.pop(0)
+        elif arg == '-s':
+            name, value = args.pop(0).split('=', 1)
+            try:
+                value = float(value)
+            except ValueError:
+                try:
+                    value = json.loads(value) # lists such as a quaternion
+                except ValueError:
+                    pass # a string
+            settings[name] = value
+        else:
+            print('unknown argument', arg)
+            exit(1)
+
+    samples = load_samples(sys.argv[1])
+    persistent_data = LoadPersistentData(persistent_path, False)
+    f = False
+    if output:
+        def f(data):
+            output.write(json.dumps(data) + '\n')
+
+    t0 = time.time()
+    rate = replay(samples, settings, block, f, persistent_data)
+    print('replayed %d samples in %.2fs, %d samples/sec' % (len(samples), time.time() - t0, rate))
+    if output:
+        output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# unix domain socket shared by local clients and servers to avoid tcp
+# overhead, kept in the user's directory so no other user can create it
+
+import os, socket
+
+# by port, without HOME this is in /.pypilot like the client config
+UNIX_SOCKET_PATH = os.getenv('HOME', '') + '/.pypilot/pypilot.%d.sock'
+
+# listening unix domain socket for local clients, only this user may connect
+def BindUnixSocket(port):
+    path = UNIX_SOCKET_PATH % port
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    # the tcp port is bound so any existing path is stale
+    if os.path.lexists(path):
+        os.unlink(path)
+
+    unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077) # created without access for others
+    try:
+        unix_socket.bind(path)
+        unix_socket.listen(5)
+    except:
+        unix_socket.close()
+        raise
+    finally:
+        os.umask(umask)
+    return unix_socket
@@ -7,7 +7,7 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import multiprocessing, select
+import multiprocessing, select, json
 from pilot import AutopilotPilot, AutopilotGain
 from pypilot.values import * # needed?
 #from pypilot.pipeserver import NonBlockingPipe
@@ -17,6 +17,16 @@ from pypilot.values import *
 import multiprocessing
 import select
 
+# gets are answered from values received within this many seconds
+default_mirror_age = 1
+
+# sets to these values skip the queue of telemetry requests
+default_control_names = ['servo.command', 'ap.enabled', 'ap.heading_command', 'ap.mode']
+
+# values per message down the pipe, small messages fit in the space
+# free when the pipe polls writable so sending does not block
+max_pipe_sets = 20
+
 class NonBlockingPipeEnd(object):
     def __init__(self, pipe, name, recvfailok):
         self.pipe = pipe
@@ -56,10 +66,16 @@ def NonBlockingPipe(name, recvfailok=False):
   return NonBlockingPipeEnd(pipe[0], name+'[0]', recvfailok), NonBlockingPipeEnd(pipe[1], name+'[1]', recvfailok)
 
 class pypilotPipeServerClient(pypilotServer):
-    def __init__(self, pipe, port, persistent_path):
+    def __init__(self, pipe, control_pipe, control_names, port, persistent_path, mirror_age=default_mirror_age):
       super(pypilotPipeServerClient, self).__init__(port, persistent_path)
+      self.control_pipe = control_pipe
+      self.control_names = set(control_names)
+      self.mirror_age = mirror_age
+      self.received = {} # time each value last arrived from the pipe
       self.watches = {}
       self.gets = {}
+      self.snapshot_sockets = []
+      self.registered = False
       self.pipe = pipe
 
     def __del__(self):
@@ -67,32 +83,78 @@ class pypilotPipeServerClient(pypilotServer):
         pass
       super(pypilotPipeServerClient, self).__del__()
 
+    def Listen(self):
+      if not super(pypilotPipeServerClient, self).Listen():
+        return False
+      # wake from polling sockets when pipe messages arrive
+      self.poller.register(self.pipe, select.POLLIN)
+      return True
+
+    def PollSockets(self, timeout=0):
+      super(pypilotPipeServerClient, self).PollSockets(timeout)
+      while self.HandlePipeMessage():
+        pass
+      self.FlushSockets()
+
     def Register(self, value):
       super(pypilotPipeServerClient, self).Register(value)
       self.gets[value.name] = []
       return value
     
+    # true if the value in this process can answer a get
+    def Mirrored(self, name, t):
+        if name in self.watches:
+            return True
+        return name in self.received and t - self.received[name] < self.mirror_age
+
     def RemoveSocket(self, socket):
+      names = self.socket_watches.get(socket, ())
       super(pypilotPipeServerClient, self).RemoveSocket(socket)
-      for name in self.values:
-          if not self.values[name].watchers and name in self.watches:
+      for name in names:
+          value = self.values[name]
+          if not value.watchers and not value.periodic_watchers and name in self.watches:
               self.pipe.send({'method': 'watch', 'name': name, 'value': False})
               del self.watches[name]
 
+    def GetValues(self, socket, names):
+        watched, requested = [], []
+        t = time.time()
+        for name in names:
+            if self.Mirrored(name, t): # already have recent value in this process
+                watched.append(name)
+            else:
+                self.gets[name].append(socket)
+                requested.append(name)
+
+        if watched:
+            super(pypilotPipeServerClient, self).GetValues(socket, watched)
+        if requested:
+            self.pipe.send({'method': 'get_many', 'names': requested})
+
+    def SendSnapshot(self, socket):
+        # one request down the pipe serves every socket waiting on it
+        if not self.snapshot_sockets:
+            self.pipe.send({'method': 'snapshot'})
+        self.snapshot_sockets.append(socket)
+
     def HandleNamedRequest(self, socket, data):
         method = data['method']
         name = data['name']
         value = self.values[name]
 
         if method == 'get':
-          if name in self.watches: # already have recent value in this process
+          if self.Mirrored(name, time.time()): # already have recent value in this process
             socket.send(value.get_pypilot() + '\n')
           else:
             self.gets[name].append(socket)
             self.pipe.send(data)
         elif method == 'set':
             data['value'] # throw exception if there is no value field
-            self.pipe.send(data)
+            self.received.pop(name, None) # the autopilot may not accept it
+            if name in self.control_names:
+                self.control_pipe.send(data)
+            else:
+                self.pipe.send(data)
         elif method == 'watch':
           super(pypilotPipeServerClient, self).HandleNamedRequest(socket, data)
           watch = data['value'] if 'value' in data else True
@@ -100,25 +162,39 @@ class pypilotPipeServerClient(pypilotServer):
             if not name in self.watches:
               self.watches[name] = True
               self.pipe.send({'method': 'watch', 'name': name, 'value': True})
-          elif not value.watchers and name in self.watches:
+          elif not value.watchers and not value.periodic_watchers and name in self.watches:
             del self.watches[name]
             self.pipe.send({'method': 'watch', 'name': name, 'value': False})
         else:
           print('unimplemented pipe method', method)
 
-    def HandlePipeMessage(self):
-        msgs = self.pipe.recv()
+    def HandlePipeMessage(self, timeout=0):
+        msgs = self.pipe.recv(timeout)
         if not msgs:
             return False
 
+        t = time.time()
         for msg in msgs:
             name, param = msg
             if name == '_register':
-                self.Register(param)
+                self.Register(MirrorValue(param))
+                continue
+
+            if name == '_registered':
+                self.registered = True
+                continue
+
+            if name == '_snapshot': # all values were sent ahead of this
+                self.snapshot = False
+                for socket in self.snapshot_sockets:
+                    super(pypilotPipeServerClient, self).SendSnapshot(socket)
+                self.snapshot_sockets = []
                 continue
             
             value = self.values[name]
             value.value = param
+            value.encoded = False
+            self.received[name] = t
             value.send() # send to watching clients
 
             # send to any clients who requested this value (get request)
@@ -130,47 +206,51 @@ class pypilotPipeServerClient(pypilotServer):
               self.gets[name] = []
         return True
 
-def pipe_server_process(pipe, port, persistent_path):
+def pipe_server_process(pipe, control_pipe, control_names, port, persistent_path, mirror_age):
     #print('pipe server on', os.getpid())
-    server = pypilotPipeServerClient(pipe, port, persistent_path)
-    # handle only pipe messages (to get all registrations) for first second
-    t0 = time.time()
-    while time.time() - t0 < 2:
-      while server.HandlePipeMessage():
-        pass
-      time.sleep(.1)
+    server = pypilotPipeServerClient(pipe, control_pipe, control_names, port, persistent_path, mirror_age)
+    # handle only pipe messages until all values are registered
+    while not server.registered:
+      server.HandlePipeMessage(1)
 
+    # block until either the pipe or a socket is ready
     while True:
-        while server.HandlePipeMessage():
-            pass
-        server.HandleRequests()
-        time.sleep(.1)
+        server.HandleRequests(server.PollTimeout(1))
 
 
 class pypilotPipeServer(object):
-    def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path):
+    def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path, control_names=default_control_names, mirror_age=default_mirror_age):
         self.pipe, process_pipe = NonBlockingPipe('pypilotpipeserver', True)
+        # control sets have their own pipe so they are not behind telemetry
+        self.control_pipe, process_control_pipe = NonBlockingPipe('pypilotcontrolpipe', True)
     
         self.values = {}
-        self.sets = []
+        self.registrations = [] # schemas of values to register in the server process
+        self.registered = False
+        self.sets = {} # latest value to send for each name
+        self.snapshot = False
         self.last_recv = time.time()
 
         self.persistent_data = LoadPersistentData(persistent_path, False)
         self.ResetPersistentState()
+
+        # changed values are sent to clients at most this often
+        self.publish_rate = self.Register(RangeProperty('server.publish_rate', 25, 1, 100, persistent=True))
+        self.publish_time = 0
         
-        self.process = multiprocessing.Process(target=pipe_server_process, args=(process_pipe, port, persistent_path))
+        self.process = multiprocessing.Process(target=pipe_server_process, args=(process_pipe, process_control_pipe, control_names, port, persistent_path, mirror_age))
         self.process.start()
           
     def __del__(self):
       # ensure persistent values get sent to server process
       self.SetPersistentValues()
-      self.pipe.send(self.sets, False)
+      self.pipe.send(list(self.sets.items()), False)
       self.process.terminate()
         
     def SetPersistentValues(self):
       for name in self.persistent_sets:
         if self.persistent_sets[name]:
-          self.sets.append((name, self.values[name].value))
+          self.sets[name] = self.values[name].value
       self.ResetPersistentState()
 
     def ResetPersistentState(self):
@@ -178,7 +258,7 @@ class pypilotPipeServer(object):
       self.persistent_sets = {}
 
     def queue_send(self, value):
-      self.sets.append((value.name, value.value))
+      self.sets[value.name] = value.value
 
       if value.persistent:
         self.persistent_sets[value.name] = False
@@ -187,7 +267,8 @@ class pypilotPipeServer(object):
         if value.persistent and value.name in self.persistent_data:
             value.set(self.persistent_data[value.name])
       
-        self.pipe.send([('_register', value)])
+        # taken now, before the owner attaches other objects to the value
+        self.registrations.append(value_schema(value))
         self.values[value.name] = value
 
         def make_send():
@@ -202,6 +283,16 @@ class pypilotPipeServer(object):
 
     def HandleRequest(self, request):
       method = request['method']
+      if method == 'get_many':
+        for name in request['names']:
+          self.queue_send(self.values[name])
+        return
+      elif method == 'snapshot':
+        for name in self.values:
+          self.queue_send(self.values[name])
+        self.snapshot = True
+        return
+
       name = request['name']
       if method == 'get':
         self.queue_send(self.values[name])
@@ -212,21 +303,57 @@ class pypilotPipeServer(object):
       elif method == 'watch':
           self.values[name].watchers = request['value']
         
+    # apply any pending control sets, called before the values are used
+    def HandleControlRequests(self):
+        while True:
+            request = self.control_pipe.recv()
+            if not request:
+                break
+            name = request['name']
+            if name in self.values:
+                self.values[name].set(request['value'])
+
     def HandleRequests(self):
+        # register all new values in one message, the
+        # values are registered before the first call
+        if self.registrations or not self.registered:
+            msg = [('_register', schema) for schema in self.registrations]
+            if not self.registered:
+                msg.append(('_registered', True))
+                self.registered = True
+            self.pipe.send(msg)
+            self.registrations = []
+
+        # in case the caller has no separate control step
+        self.HandleControlRequests()
+
         t0 = time.time()
         if t0 >= self.persistent_timeout:
             self.SetPersistentValues()
 
+        # send each changed value once, if the pipe is full
+        # keep the latest values until the next iteration
         ta = time.time()
-        while self.sets:
-            if self.pipe.send(self.sets[:20], False):
-                self.sets = self.sets[20:]
-            else:
-                break
+        if self.snapshot or (self.sets and ta >= self.publish_time):
+            sets = list(self.sets.items())
+            if self.snapshot: # snapshot is taken after all values arrive
+                sets.append(('_snapshot', True))
+            count = len(sets)
+            while sets:
+                msg = sets[:max_pipe_sets]
+                if not self.pipe.send(msg, False):
+                    break # the rest are sent on later iterations
+                for name, value in msg:
+                    self.sets.pop(name, None)
+                sets = sets[max_pipe_sets:]
+
+            if not sets:
+                self.snapshot = False
+                self.publish_time = ta + 1.0/self.publish_rate.value
 
-        dta = time.time() - ta
-        if dta > .02:
-            print('too long to send sets down pipe', dta, l)
+            dta = time.time() - ta
+            if dta > .02:
+                print('too long to send sets down pipe', dta, count)
 
         while True:
             request = self.pipe.recv()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2019 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# json codec used to parse and encode the pypilot protocol
+# an accelerated library is used if available
+
+from __future__ import print_function
+import json
+
+try:
+    import ujson
+    loads = ujson.loads
+    dumps = ujson.dumps
+    codec = 'ujson'
+except ImportError:
+    try:
+        import orjson
+        loads = orjson.loads
+        def dumps(obj):
+            return orjson.dumps(obj).decode()
+        codec = 'orjson'
+    except ImportError:
+        print('WARNING: no accelerated json library (ujson), parsing will consume more cpu')
+        loads = json.loads
+        dumps = json.dumps
+        codec = 'json'
+
+# compare lines/sec of the stdlib and selected codec on protocol messages
+def benchmark(count=100000):
+    import time
+    lines = ['{"method": "set", "name": "servo.command", "value": 0.25}',
+             '{"imu.heading": {"value": 123.456}}',
+             '{"imu.fusionQPose": {"value": [0.7071068, -0.7071068, 0.0000000, 0.0000000]}}',
+             '{"ap.mode": {"value": "compass"}}']
+    msgs = list(map(json.loads, lines))
+    n = count // len(lines) * len(lines)
+
+    def rate(f, data):
+        t0 = time.time()
+        for i in range(count // len(data)):
+            for d in data:
+                f(d)
+        return n / (time.time() - t0)
+
+    print('%-8s %14s %14s' % ('codec', 'loads lines/s', 'dumps lines/s'))
+    print('%-8s %14d %14d' % ('json', rate(json.loads, lines), rate(json.dumps, msgs)))
+    if codec != 'json':
+        print('%-8s %14d %14d' % (codec, rate(loads, lines), rate(dumps, msgs)))
+
+if __name__ == '__main__':
+    benchmark()
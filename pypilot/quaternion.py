@@ -10,6 +10,11 @@
 from pypilot import vector
 import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
 def angvec2quat(angle, v):
     n = vector.norm(v)
     if n == 0:
@@ -63,3 +68,83 @@ def normalize(q):
         total += v*v
     d = math.sqrt(total)
     return [q[0] / d, q[1] / d, q[2] / d, q[3] / d]
+
+# batch versions operate on numpy arrays of shape (N, 4) for
+# quaternions and (N, 3) for vectors, a single quaternion or vector
+# of shape (4,) or (3,) is broadcast against the others
+#
+# each is a constant matrix applied to the 16 pairwise products
+# of quaternion components, so only a few numpy calls are made
+
+def products_matrix(terms, columns):
+    m = numpy.zeros((16, columns))
+    for column, i, j, sign in terms:
+        m[4*i+j, column] += sign
+    return m
+
+def products(q1, q2):
+    p = q1[..., :, None]*q2[..., None, :]
+    return p.reshape(p.shape[:-2] + (16,))
+
+if numpy:
+    multiply_terms = products_matrix([(0, 0, 0, 1), (0, 1, 1, -1), (0, 2, 2, -1), (0, 3, 3, -1),
+                                      (1, 0, 1, 1), (1, 1, 0, 1), (1, 2, 3, 1), (1, 3, 2, -1),
+                                      (2, 0, 2, 1), (2, 1, 3, -1), (2, 2, 0, 1), (2, 3, 1, 1),
+                                      (3, 0, 3, 1), (3, 1, 2, 1), (3, 2, 1, -1), (3, 3, 0, 1)], 4)
+
+    # rotation matrix of q v q* by rows
+    rotation_terms = products_matrix([(0, 0, 0, 1), (0, 1, 1, 1), (0, 2, 2, -1), (0, 3, 3, -1),
+                                      (1, 1, 2, 2), (1, 0, 3, -2),
+                                      (2, 1, 3, 2), (2, 0, 2, 2),
+                                      (3, 1, 2, 2), (3, 0, 3, 2),
+                                      (4, 0, 0, 1), (4, 1, 1, -1), (4, 2, 2, 1), (4, 3, 3, -1),
+                                      (5, 2, 3, 2), (5, 0, 1, -2),
+                                      (6, 1, 3, 2), (6, 0, 2, -2),
+                                      (7, 2, 3, 2), (7, 0, 1, 2),
+                                      (8, 0, 0, 1), (8, 1, 1, -1), (8, 2, 2, -1), (8, 3, 3, 1)], 9)
+
+    # arguments of atan2, asin and atan2 for roll, pitch and heading
+    euler_terms = products_matrix([(0, 2, 3, 2), (0, 0, 1, 2),
+                                   (1, 1, 1, -2), (1, 2, 2, -2),
+                                   (2, 0, 2, 2), (2, 1, 3, -2),
+                                   (3, 1, 2, 2), (3, 0, 3, 2),
+                                   (4, 2, 2, -2), (4, 3, 3, -2)], 5)
+
+def multiply_batch(q1, q2):
+    q1, q2 = numpy.asarray(q1, dtype=float), numpy.asarray(q2, dtype=float)
+    return products(q1, q2).dot(multiply_terms)
+
+def rotvecquat_batch(v, q):
+    v, q = numpy.asarray(v, dtype=float), numpy.asarray(q, dtype=float)
+    r = products(q, q).dot(rotation_terms)
+    r = r.reshape(r.shape[:-1] + (3, 3))
+    return numpy.matmul(r, v[..., :, None])[..., 0]
+
+def toeuler_batch(q):
+    q = numpy.asarray(q, dtype=float)
+    e = products(q, q).dot(euler_terms)
+    roll = numpy.arctan2(e[..., 0], 1 + e[..., 1])
+    pitch = numpy.arcsin(numpy.minimum(numpy.maximum(e[..., 2], -1), 1))
+    heading = numpy.arctan2(e[..., 3], 1 + e[..., 4])
+    return roll, pitch, heading
+
+def angvec2quat_batch(angle, v):
+    angle, v = numpy.asarray(angle, dtype=float), numpy.asarray(v, dtype=float)
+    n = vector.norm_batch(v)
+    fac = numpy.sin(angle/2) / numpy.where(n == 0, 1, n)
+    fac = numpy.where(n == 0, 0, fac)
+    return numpy.concatenate([numpy.cos(angle/2)[..., None], v*fac[..., None]], axis=-1)
+
+def vec2vec2quat_batch(a, b):
+    a, b = numpy.asarray(a, dtype=float), numpy.asarray(b, dtype=float)
+    n = vector.cross_batch(a, b)
+    fac = vector.dot_batch(a, b) / vector.norm_batch(a) / vector.norm_batch(b)
+    fac = numpy.minimum(numpy.maximum(fac, -1), 1) # protect against possible slight numerical errors
+    return angvec2quat_batch(numpy.arccos(fac), n)
+
+def conjugate_batch(q):
+    return numpy.asarray(q, dtype=float) * [1, -1, -1, -1]
+
+def normalize_batch(q):
+    q = numpy.asarray(q, dtype=float)
+    return q / numpy.linalg.norm(q, axis=-1, keepdims=True)
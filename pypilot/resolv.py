@@ -7,9 +7,18 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
 def resolv(angle, offset=0):
     while offset - angle > 180:
         angle += 360
     while offset - angle <= -180:
         angle -= 360
     return angle
+
+# resolv for arrays of angles and offsets
+def resolv_batch(angle, offset=0):
+    return offset + (numpy.asarray(angle, dtype=float) - offset + 180) % 360 - 180
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2020 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# single producer single consumer ring buffer in shared memory
+# carrying fixed format records between forked processes
+#
+# records are packed binary instead of pickled, a byte written to a
+# pipe for each record makes the reader poll-able like NonBlockingPipe
+
+from __future__ import print_function
+import os, mmap, struct, select, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
+# fields are (name, count) where count of 1 is a number, more
+# is a list of numbers, and 0 is a flag only present when set
+class RecordFormat(object):
+    def __init__(self, fields):
+        self.fields = fields
+        fmt = '<B' # leading byte is zero for a False record
+        for name, count in fields:
+            fmt += '?' if count == 0 else '%dd' % count
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.invalid = bytes(bytearray(self.size))
+
+        # position of each field in the unpacked values
+        self.index = {}
+        i = 1
+        for name, count in fields:
+            self.index[name] = slice(i, i+count) if count > 1 else i
+            i += max(count, 1)
+
+        # equivalent packed numpy record to read many at once
+        if numpy:
+            dtype = [('_valid', 'u1')]
+            for name, count in fields:
+                if count == 0:
+                    dtype.append((name, '?'))
+                elif count == 1:
+                    dtype.append((name, '<f8'))
+                else:
+                    dtype.append((name, '<f8', (count,)))
+            self.dtype = numpy.dtype(dtype)
+
+    def pack_into(self, buf, offset, data):
+        if not data:
+            buf[offset:offset+self.size] = self.invalid
+            return
+
+        values = [1]
+        for name, count in self.fields:
+            if count == 0:
+                values.append(name in data and not not data[name])
+            elif count == 1:
+                values.append(data[name])
+            else:
+                values.extend(data[name])
+        self.struct.pack_into(buf, offset, *values)
+
+    # convert between lists of dicts and numpy record arrays
+    def to_array(self, records):
+        array = numpy.zeros(len(records), self.dtype)
+        array['_valid'] = 1
+        for name, count in self.fields:
+            if count == 0:
+                array[name] = [name in record and not not record[name] for record in records]
+            else:
+                array[name] = [record[name] for record in records]
+        return array
+
+    # unpacked values of each record, faster than dicts to iterate
+    def to_tuples(self, array):
+        buf = array.tobytes() # packed the same as the struct
+        return [self.struct.unpack_from(buf, i*self.size) for i in range(len(array))]
+
+    def to_dicts(self, array):
+        return [self.to_dict(values) for values in self.to_tuples(array)]
+
+    def unpack_from(self, buf, offset):
+        return self.to_dict(self.struct.unpack_from(buf, offset))
+
+    def to_dict(self, values):
+        if not values[0]:
+            return False
+
+        data = {}
+        for name, count in self.fields:
+            i = self.index[name]
+            if count == 0:
+                if values[i]:
+                    data[name] = True
+            elif count == 1:
+                data[name] = values[i]
+            else:
+                data[name] = list(values[i])
+        return data
+
+class RingBuffer(object):
+    def __init__(self, fields, slots):
+        self.format = RecordFormat(fields)
+        self.slots = slots
+        # the first 4 bytes hold the count of records read
+        self.buf = mmap.mmap(-1, 4 + slots*self.format.size)
+
+    def read_count(self):
+        return struct.unpack_from('<I', self.buf, 0)[0]
+
+    def set_read_count(self, count):
+        struct.pack_into('<I', self.buf, 0, count & 0xffffffff)
+
+    def offset(self, index):
+        return 4 + (index % self.slots) * self.format.size
+
+class RingBufferReader(object):
+    def __init__(self, ring, fd, name, recvfailok):
+        self.ring = ring
+        self.fd = fd
+        self.pollin = select.poll()
+        self.pollin.register(fd, select.POLLIN)
+        self.name = name
+        self.recvfailok = recvfailok
+        self.count = 0
+
+    def fileno(self):
+        return self.fd
+
+    def recv(self, timeout=0):
+        if not self.pollin.poll(1000.0*timeout):
+            if not self.recvfailok:
+                print('error ring buffer block on recv!', self.name)
+            return False
+
+        os.read(self.fd, 1)
+        data = self.ring.format.unpack_from(self.ring.buf, self.ring.offset(self.count))
+        self.count += 1
+        self.ring.set_read_count(self.count)
+        return data
+
+    # all queued records as a numpy record array, records
+    # sent as False are dropped so the result may be empty
+    def recv_array(self):
+        ring = self.ring
+        if not self.pollin.poll(0):
+            return numpy.zeros(0, ring.format.dtype)
+        count = len(os.read(self.fd, ring.slots))
+
+        # copy out the bytes in at most two pieces around the end of
+        # the buffer, much faster than copying numpy record arrays
+        data = b''
+        index = self.count % ring.slots
+        while count:
+            n = min(count, ring.slots - index)
+            offset = ring.offset(index)
+            data += ring.buf[offset:offset + n*ring.format.size]
+            count -= n
+            self.count += n
+            index = 0
+        self.ring.set_read_count(self.count)
+        records = numpy.frombuffer(data, ring.format.dtype)
+        if b'\0' in data[::ring.format.size]: # leading byte of each record
+            records = records[records['_valid'] != 0]
+        return records
+
+class RingBufferWriter(object):
+    def __init__(self, ring, fd, name):
+        self.ring = ring
+        self.fd = fd
+        self.name = name
+        self.count = 0
+        self.sendfailcount = 0
+        self.failcountmsg = 1
+
+    def fileno(self):
+        return self.fd
+
+    def full(self):
+        return (self.count - self.ring.read_count()) & 0xffffffff >= self.ring.slots
+
+    def send(self, value, block=True):
+        while self.full():
+            if block:
+                time.sleep(.001)
+                continue
+
+            self.sendfailcount += 1
+            if self.sendfailcount == self.failcountmsg:
+                print('ring buffer full (%d)' % self.sendfailcount, self.name, 'cannot send')
+                self.failcountmsg *= 10
+            return False
+
+        self.ring.format.pack_into(self.ring.buf, self.ring.offset(self.count), value)
+        self.count += 1
+        os.write(self.fd, b'\0') # record is complete before the reader is woken
+        return True
+
+# create the reading and writing ends, which must be shared by fork
+def RingBufferPipe(name, fields, slots=64, recvfailok=False):
+    ring = RingBuffer(fields, slots)
+    r, w = os.pipe()
+    return RingBufferReader(ring, r, name+'[0]', recvfailok), RingBufferWriter(ring, w, name+'[1]')
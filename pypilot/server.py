@@ -12,17 +12,24 @@ import select, socket, time, numbers, json
 
 import fcntl, os
 from pypilot.values import *
+from pypilot import pyjson
 from pypilot.bufferedsocket import LineBufferedNonBlockingSocket
+from pypilot.localsocket import UNIX_SOCKET_PATH, BindUnixSocket
 
 DEFAULT_PORT = 21311
 max_connections = 30
+max_journal_size = 65536 # compact persistent data once the journal is larger
 default_persistent_path = os.getenv('HOME') + '/.pypilot/pypilot.conf'
 
+def ReadPersistentFile(path):
+    file = open(path)
+    persistent_data = json.loads(file.read())
+    file.close()
+    return persistent_data
+
 def LoadPersistentData(persistent_path, server=True):
     try:
-        file = open(persistent_path)
-        persistent_data = json.loads(file.read())
-        file.close()
+        persistent_data = ReadPersistentFile(persistent_path)
     except Exception as e:
         print('failed to load', persistent_path, e)
 
@@ -34,21 +41,58 @@ def LoadPersistentData(persistent_path, server=True):
             file.close()
 
         try:
-            file = open(persistent_path + '.bak')
-            persistent_data = json.loads(file.read())
-            file.close()
-            return persistent_data
+            persistent_data = ReadPersistentFile(persistent_path + '.bak')
         except Exception as e:
             print('backup data failed as well', e)
-        return {}
+            persistent_data = {}
 
-    if server:
-        # backup persistent_data if it loaded with success
-        file = open(persistent_path + '.bak', 'w')
-        file.write(json.dumps(persistent_data)+'\n')
+    # apply changes journaled since the file was last written
+    journal_path = persistent_path + '.journal'
+    if os.path.exists(journal_path):
+        file = open(journal_path)
+        for line in file:
+            try:
+                persistent_data.update(json.loads(line))
+            except Exception as e: # likely an incomplete last write
+                print('invalid entry in', journal_path, e)
         file.close()
     return persistent_data
-    
+
+# index of registered names by their dot separated parts
+class NameTrie(object):
+    def __init__(self):
+        self.children = {}
+        self.name = False # registered name ending at this node
+
+    def add(self, name):
+        node = self
+        for part in name.split('.'):
+            if not part in node.children:
+                node.children[part] = NameTrie()
+            node = node.children[part]
+        node.name = name
+
+    def collect(self, names):
+        if self.name:
+            names.append(self.name)
+        for part in self.children:
+            self.children[part].collect(names)
+
+    # all names starting with prefix
+    def match(self, prefix):
+        parts = prefix.split('.')
+        node = self
+        for part in parts[:-1]:
+            if not part in node.children:
+                return []
+            node = node.children[part]
+
+        names = []
+        for part in node.children:
+            if part.startswith(parts[-1]):
+                node.children[part].collect(names)
+        return names
+
 class pypilotServer(object):
     def __init__(self, port=DEFAULT_PORT, persistent_path=default_persistent_path):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -56,40 +100,93 @@ class pypilotServer(object):
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         self.port = port
+        self.unix_socket = False
         self.init = False
         self.sockets = []
+        self.socket_watches = {} # names of values watched by each socket
         self.values = {}
+        self.name_trie = NameTrie()
+        self.pattern_watches = {} # watch requests by socket for each name prefix
+        self.snapshot = False # all values encoded at most once per poll
+        self.list_entries = {} # encoded type of each value
+        self.list_cache = False # encoded list of all values, prefixes are not cached
+        self.periodic_values = set() # names of values with rate limited watchers
 
         self.persistent_path = persistent_path
         self.persistent_timeout = time.time() + 300
         self.persistent_data = LoadPersistentData(persistent_path)
+        self.persistent_dirty = set() # names of persistent values changed since last store
+        try:
+            self.journal_size = os.path.getsize(persistent_path + '.journal')
+        except OSError:
+            self.journal_size = 0
+        # changes journaled without the file they apply to are written in full
+        if self.journal_size and not os.path.exists(persistent_path):
+            self.CompactPersistentData()
 
     def __del__(self):
         self.StorePersistentValues()
         self.server_socket.close()
+        if self.unix_socket:
+            self.unix_socket.close()
+            try:
+                os.unlink(UNIX_SOCKET_PATH % self.port)
+            except OSError:
+                pass
         for socket in self.sockets:
             socket.socket.close()
             
     def StorePersistentValues(self):
         self.persistent_timeout = time.time() + 30 # 30 seconds
-        need_store = False
-        for name in self.values:
+        changes = {}
+        for name in self.persistent_dirty:
             value = self.values[name]
-            if not value.persistent:
-                continue
             if not name in self.persistent_data or value.value != self.persistent_data[name]:
-                self.persistent_data[name] = value.value
-                need_store = True
+                changes[name] = value.value
+        self.persistent_dirty = set()
 
-        if not need_store:
+        if not changes:
             return
-                
+
+        self.persistent_data.update(changes)
+        # the full file is written first, as on a fresh install
+        if self.journal_size > max_journal_size or not os.path.exists(self.persistent_path):
+            self.CompactPersistentData()
+            return
+
+        # append only the changes with a single write and sync
+        journal_path = self.persistent_path + '.journal'
         try:
-            file = open(self.persistent_path, 'w')
+            entry = json.dumps(changes) + '\n'
+            file = open(journal_path, 'a')
+            file.write(entry)
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            self.journal_size += len(entry)
+        except Exception as e:
+            print('failed to write', journal_path, e)
+
+    # rewrite all persistent data and empty the journal
+    def CompactPersistentData(self):
+        path = self.persistent_path
+        try:
+            file = open(path + '.tmp', 'w')
             file.write(json.dumps(self.persistent_data).replace(',', ',\n')+'\n')
+            file.flush()
+            os.fsync(file.fileno())
             file.close()
+
+            # keep the last complete file as a backup, the journal is
+            # still intact if interrupted before the new file is in place
+            if os.path.exists(path):
+                os.rename(path, path + '.bak')
+            os.rename(path + '.tmp', path)
+
+            open(path + '.journal', 'w').close()
+            self.journal_size = 0
         except Exception as e:
-            print('failed to write', self.persistent_path, e)
+            print('failed to write', path, e)
 
     def Register(self, value):
         if value.persistent and value.name in self.persistent_data:
@@ -102,16 +199,105 @@ class pypilotServer(object):
             print('warning, registering existing value:', value.name)
             
         self.values[value.name] = value
+
+        t = value.type()
+        if type(t) == type(''):
+            t = {'type' : t}
+        self.list_entries[value.name] = pyjson.dumps(value.name) + ': ' + pyjson.dumps(t)
+        self.list_cache = False
+
+        # apply existing pattern watches to the new value
+        self.name_trie.add(value.name)
+        for prefix in self.pattern_watches:
+            if value.name.startswith(prefix):
+                for socket, data in self.pattern_watches[prefix].items():
+                    request = dict(data)
+                    request['name'] = value.name
+                    self.HandleNamedRequest(socket, request)
+
+        if value.persistent:
+            if not value.name in self.persistent_data:
+                self.persistent_dirty.add(value.name)
+
+            # track changes so storing does not scan every value
+            def make_send():
+                send = value.send
+                def persistent_send():
+                    self.persistent_dirty.add(value.name)
+                    send()
+                return persistent_send
+            value.send = make_send()
         return value
 
-    def ListValues(self, socket):
-        msg = {}
-        for value in self.values:
-            t = self.values[value].type()
-            if type(t) == type(''):
-                t = {'type' : t}
-            msg[value] = t
-        socket.send(json.dumps(msg) + '\n')
+    def ListValues(self, socket, prefix=''):
+        if prefix:
+            entries = [self.list_entries[name] for name in self.list_entries if name.startswith(prefix)]
+            socket.send('{' + ', '.join(entries) + '}\n')
+            return
+
+        if not self.list_cache:
+            self.list_cache = '{' + ', '.join(self.list_entries.values()) + '}\n'
+        socket.send(self.list_cache)
+
+    # combine values into a single message
+    def JoinValues(self, names):
+        return '{' + ', '.join([self.values[name].get_pypilot()[1:-1] for name in names]) + '}\n'
+
+    def GetValues(self, socket, names):
+        socket.send(self.JoinValues(names))
+
+    def SendSnapshot(self, socket):
+        if not self.snapshot:
+            self.snapshot = self.JoinValues(self.values)
+        socket.send(self.snapshot)
+
+    def HandleManyRequest(self, socket, data):
+        method = data['method']
+        names = []
+        for name in data['names']:
+            if name in self.values:
+                names.append(name)
+            else:
+                socket.send('invalid request: ' + method + ' unknown value: ' + name + '\n')
+
+        if method == 'get_many':
+            self.GetValues(socket, names)
+        else: # watch_many
+            request = dict(data)
+            request['method'] = 'watch'
+            for name in names:
+                request['name'] = name
+                self.HandleNamedRequest(socket, request)
+
+    # watch names ending in * apply to all values starting with
+    # the rest of the name, including values registered later
+    def HandlePatternWatch(self, socket, data):
+        prefix = data['name'][:-1]
+        watch = data['value'] if 'value' in data else True
+        names = self.name_trie.match(prefix)
+        # current values are requested before watching, once
+        # watched a mirror of the value is assumed to be current
+        if watch and names:
+            self.GetValues(socket, names)
+
+        request = dict(data)
+        for name in names:
+            request['name'] = name
+            self.HandleNamedRequest(socket, request)
+
+        if watch:
+            if not prefix in self.pattern_watches:
+                self.pattern_watches[prefix] = {}
+            self.pattern_watches[prefix][socket] = data
+        elif prefix in self.pattern_watches:
+            self.RemovePatternWatch(prefix, socket)
+
+    def RemovePatternWatch(self, prefix, socket):
+        watches = self.pattern_watches[prefix]
+        if socket in watches:
+            del watches[socket]
+            if not watches:
+                del self.pattern_watches[prefix]
 
     def HandleNamedRequest(self, socket, data):
         method = data['method']
@@ -127,21 +313,41 @@ class pypilotServer(object):
                 socket.send('value: ' + name + ' is readonly\n')
         elif method == 'watch':
             watch = data['value'] if 'value' in data else True
-            if socket in value.watchers:
-                if not watch:
-                    value.watchers.remove(socket)
-            elif watch:
-                value.watchers.append(socket)
+            period = data['period'] if 'period' in data else 0
+            value.watchers.discard(socket)
+            if socket in value.periodic_watchers:
+                del value.periodic_watchers[socket]
+
+            if watch:
+                if period > 0:
+                    value.periodic_watchers[socket] = PeriodicWatch(period)
+                else:
+                    value.watchers.add(socket)
+                self.socket_watches[socket].add(name)
+            else:
+                self.socket_watches[socket].discard(name)
+
+            if value.periodic_watchers:
+                self.periodic_values.add(name)
+            else:
+                self.periodic_values.discard(name)
         else:
             socket.send('invalid method: ' + method + ' for ' + name + '\n')
         
     def HandleRequest(self, socket, request):
-        data = json.loads(request)
-        if data['method'] == 'list':
-            self.ListValues(socket)
+        data = pyjson.loads(request)
+        method = data['method']
+        if method == 'list':
+            self.ListValues(socket, data['prefix'] if 'prefix' in data else '')
+        elif method == 'snapshot':
+            self.SendSnapshot(socket)
+        elif method == 'get_many' or method == 'watch_many':
+            self.HandleManyRequest(socket, data)
         else:
             name = data['name']
-            if not name in self.values:
+            if method == 'watch' and name.endswith('*'):
+                self.HandlePatternWatch(socket, data)
+            elif not name in self.values:
                 socket.send('invalid request: ' + data['method'] + ' unknown value: ' + name + '\n')
             else:
                 self.HandleNamedRequest(socket, data)
@@ -149,30 +355,39 @@ class pypilotServer(object):
     def RemoveSocket(self, socket):
         self.sockets.remove(socket)
 
-        found = False
-        for fd in self.fd_to_socket:
-            if socket == self.fd_to_socket[fd]:
-                del self.fd_to_socket[fd]
-                self.poller.unregister(fd)
-                found = True
-                break
+        if socket.fd in self.fd_to_socket:
+            del self.fd_to_socket[socket.fd]
+            self.poller.unregister(socket.fd)
+        else:
+            print('socket not found in fd_to_socket')
 
         socket.socket.close()
+        self.RemoveSocketWatches(socket)
 
-        if not found:
-            print('socket not found in fd_to_socket')
+    def RemoveSocketWatches(self, socket):
+        for prefix in list(self.pattern_watches):
+            self.RemovePatternWatch(prefix, socket)
 
-        for name in self.values:
-            if socket in self.values[name].watchers:
-                self.values[name].watchers.remove(socket)
+        # only visit the values this socket watched
+        for name in self.socket_watches.pop(socket, ()):
+            value = self.values[name]
+            value.watchers.discard(socket)
+            if socket in value.periodic_watchers:
+                del value.periodic_watchers[socket]
+                if not value.periodic_watchers:
+                    self.periodic_values.discard(name)
 
-    def PollSockets(self):
-        events = self.poller.poll(0)
+    # wait up to timeout seconds for socket events
+    def PollSockets(self, timeout=0):
+        self.snapshot = False
+        events = self.poller.poll(int(1000*timeout))
         while events:
             event = events.pop()
             fd, flag = event
+            if not fd in self.fd_to_socket:
+                continue # registered and handled by a derived class
             socket = self.fd_to_socket[fd]
-            if socket == self.server_socket:
+            if socket == self.server_socket or socket == self.unix_socket:
                 connection, address = socket.accept()
                 if len(self.sockets) == max_connections:
                     print('pypilot server: max connections reached!!!', len(self.sockets))
@@ -180,10 +395,10 @@ class pypilotServer(object):
 
                 socket = LineBufferedNonBlockingSocket(connection)
                 self.sockets.append(socket)
-                fd = socket.socket.fileno()
-                # print('new client', address, fd)
-                self.fd_to_socket[fd] = socket
-                self.poller.register(fd, select.POLLIN)
+                self.socket_watches[socket] = set()
+                # print('new client', address, socket.fd)
+                self.fd_to_socket[socket.fd] = socket
+                self.poller.register(socket.fd, select.POLLIN)
             elif flag & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
                 self.RemoveSocket(socket)
             elif flag & select.POLLIN:
@@ -199,24 +414,72 @@ class pypilotServer(object):
                         print('invalid request from socket', line, e)
                         socket.send('invalid request: ' + line + '\n')
 
+        self.FlushSockets()
+
+    def FlushSockets(self):
+        # send latest values to rate limited watchers whose period elapsed
+        if self.periodic_values:
+            t = time.time()
+            for name in self.periodic_values:
+                self.values[name].send_periodic(t)
+
         # flush all sockets
         for socket in self.sockets:
             socket.flush()
                 
-    def HandleRequests(self):
+    # local clients avoid tcp overhead with a unix domain socket
+    def ListenUnixSocket(self):
+        try:
+            unix_socket = BindUnixSocket(self.port)
+        except Exception as e:
+            # clients still connect over tcp
+            print('pypilot_server: failed to listen on', UNIX_SOCKET_PATH % self.port, e)
+            return
+
+        unix_socket.setblocking(0)
+
+        self.unix_socket = unix_socket
+        self.fd_to_socket[unix_socket.fileno()] = unix_socket
+        self.poller.register(unix_socket, select.POLLIN)
+
+    def Listen(self):
+        try:
+            self.server_socket.bind(('0.0.0.0', self.port))
+        except:
+            print('pypilot_server: bind failed; already running a server?')
+            time.sleep(1)
+            return False
+
+        self.server_socket.listen(5)
+        self.fd_to_socket = {self.server_socket.fileno() : self.server_socket}
+        self.poller = select.poll()
+        self.poller.register(self.server_socket, select.POLLIN)
+        self.ListenUnixSocket()
+        return True
+
+    # the longest HandleRequests may block without delaying
+    # persistent storage, rate limited watches or backlogged sockets
+    def PollTimeout(self, timeout):
+        t = time.time()
+        timeout = min(timeout, self.persistent_timeout - t)
+        for name in self.periodic_values:
+            for watch in self.values[name].periodic_watchers.values():
+                if watch.pending:
+                    timeout = min(timeout, watch.time - t)
+        for socket in self.sockets:
+            if socket.out_buffer or socket.out_values:
+                timeout = min(timeout, .05)
+        return max(timeout, 0)
+
+    # control sets are not queued separately without a pipe
+    def HandleControlRequests(self):
+        pass
+
+    def HandleRequests(self, timeout=0):
       if not self.init:
-          try:
-              self.server_socket.bind(('0.0.0.0', self.port))
-          except:
-              print('pypilot_server: bind failed; already running a server?')
-              time.sleep(1)
+          if not self.Listen():
               return
-
-          self.server_socket.listen(5)
           self.init = True
-          self.fd_to_socket = {self.server_socket.fileno() : self.server_socket}
-          self.poller = select.poll()
-          self.poller.register(self.server_socket, select.POLLIN)
         
       t1 = time.time()
       #print('store', t1 - self.persistent_timeout)
@@ -226,7 +489,7 @@ class pypilotServer(object):
               print('persistent store took too long!', time.time() - t1)
               return
 
-      self.PollSockets()
+      self.PollSockets(timeout)
 
 if __name__ == '__main__':
     server = pypilotServer()
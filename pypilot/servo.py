@@ -102,41 +102,24 @@ class ServoFlags(Value):
     DRIVER_TIMEOUT = 4096*4
     SATURATED = 4096*8
 
+    # flag names in the order they are listed
+    names = [(SYNC, 'SYNC'), (OVERTEMP_FAULT, 'OVERTEMP_FAULT'),
+             (OVERCURRENT_FAULT, 'OVERCURRENT_FAULT'), (ENGAGED, 'ENGAGED'),
+             (INVALID, 'INVALID'), (PORT_PIN_FAULT, 'PORT_PIN_FAULT'),
+             (STARBOARD_PIN_FAULT, 'STARBOARD_PIN_FAULT'), (BADVOLTAGE_FAULT, 'BADVOLTAGE_FAULT'),
+             (MIN_RUDDER_FAULT, 'MIN_RUDDER_FAULT'), (MAX_RUDDER_FAULT, 'MAX_RUDDER_FAULT'),
+             (BAD_FUSES, 'BAD_FUSES'), (PORT_FAULT, 'PORT_FAULT'),
+             (STARBOARD_FAULT, 'STARBOARD_FAULT'), (DRIVER_TIMEOUT, 'DRIVER_TIMEOUT'),
+             (SATURATED, 'SATURATED')]
+
     def __init__(self, name):
         super(ServoFlags, self).__init__(name, 0)
           
     def strvalue(self):
         ret = ''
-        if self.value & self.SYNC:
-            ret += 'SYNC '
-        if self.value & self.OVERTEMP_FAULT:
-            ret += 'OVERTEMP_FAULT '
-        if self.value & self.OVERCURRENT_FAULT:
-            ret += 'OVERCURRENT_FAULT '
-        if self.value & self.ENGAGED:
-            ret += 'ENGAGED '
-        if self.value & self.INVALID:
-            ret += 'INVALID '
-        if self.value & self.PORT_PIN_FAULT:
-            ret += 'PORT_PIN_FAULT '
-        if self.value & self.STARBOARD_PIN_FAULT:
-            ret += 'STARBOARD_PIN_FAULT '
-        if self.value & self.BADVOLTAGE_FAULT:
-            ret += 'BADVOLTAGE_FAULT '
-        if self.value & self.MIN_RUDDER_FAULT:
-            ret += 'MIN_RUDDER_FAULT '
-        if self.value & self.MAX_RUDDER_FAULT:
-            ret += 'MAX_RUDDER_FAULT '
-        if self.value & self.BAD_FUSES:
-            ret += 'BAD_FUSES '
-        if self.value & self.PORT_FAULT:
-            ret += 'PORT_FAULT '
-        if self.value & self.STARBOARD_FAULT:
-            ret += 'STARBOARD_FAULT '
-        if self.value & self.DRIVER_TIMEOUT:
-            ret += 'DRIVER_TIMEOUT '
-        if self.value & self.SATURATED:
-            ret += 'SATURATED '
+        for bit, name in self.names:
+            if self.value & bit:
+                ret += name + ' '
         return ret
 
     def setbit(self, bit, t=True):
@@ -159,6 +142,9 @@ class ServoFlags(Value):
     def get_pypilot(self):
         return '{"' + self.name + '": {"value": "' + self.strvalue() + '"}}'
 
+    def encoding(self):
+        return {'flags': self.names}
+
 class ServoTelemetry(object):
     FLAGS = 1
     CURRENT = 2
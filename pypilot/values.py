@@ -7,12 +7,16 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import os, time, math, json
+import os, time, math
+from pypilot import pyjson
 
 class Value(object):
     def __init__(self, name, initial, **kwargs):
         self.name = name
-        self.watchers = []
+        self.prefix = '{"' + name + '": {"value": '
+        self.encoded = False # cached get_pypilot until the value changes
+        self.watchers = set()
+        self.periodic_watchers = {} # rate limited watches by socket
         self.persistent = False
         self.set(initial)
         self.client_can_set = False
@@ -28,27 +32,65 @@ class Value(object):
         if self.value != value:
             self.set(value)
 
+    def encode_value(self, value):
+        if type(value) == type('') or type(value) == type(u''):
+            return pyjson.dumps(value)
+        return str(value)
+
+    # how values are encoded, to mirror them in another process
+    def encoding(self):
+        return False
+
     def get_pypilot(self):
-        if type(self.value) == type('') or type(self.value) == type(u''):
-            return '{"' + self.name + '": {"value": "' + self.value + '"}}'
-        return '{"' + self.name + '": {"value": ' + str(self.value) + '}}'
+        if not self.encoded:
+            self.encoded = self.prefix + self.encode_value(self.value) + '}}'
+        return self.encoded
 
     def set(self, value):
         self.value = value
+        self.encoded = False
         self.send()
 
     def send(self):
         if self.watchers:
             request = self.get_pypilot() + '\n'
             for socket in self.watchers:
-                socket.send(request)
+                socket.send_value(self.name, request)
+
+        if self.periodic_watchers:
+            for watch in self.periodic_watchers.values():
+                watch.pending = True
+            self.send_periodic(time.time())
+
+    # send to rate limited watchers whose period has elapsed
+    def send_periodic(self, t):
+        request = False
+        for socket, watch in self.periodic_watchers.items():
+            if not watch.pending or t < watch.time:
+                continue
+            if not request:
+                request = self.get_pypilot() + '\n'
+            socket.send_value(self.name, request)
+            watch.pending = False
+            watch.time = t + watch.period
+
+# a watch which sends at most one update per period,
+# the latest value is sent once the period elapses
+class PeriodicWatch(object):
+    def __init__(self, period):
+        self.period = period
+        self.time = 0
+        self.pending = False
 
 class JSONValue(Value):
     def __init__(self, name, initial, **kwargs):
       super(JSONValue, self).__init__(name, initial, **kwargs)
 
-    def get_pypilot(self):
-        return '{"' + self.name + '": {"value": ' + json.dumps(self.value) + '}}'
+    def encode_value(self, value):
+        return pyjson.dumps(value)
+
+    def encoding(self):
+        return 'json'
 
 
 def round_value(value, fmt):
@@ -70,23 +112,50 @@ def round_value(value, fmt):
     except Exception as e:
         return str(e)
 
+# format strings for fixed length vectors, by element format and length
+vector_formats = {}
+
+# format a number or flat vector with a single format operation
+# falling back to round_value for anything else
+def format_value(value, fmt):
+    t = type(value)
+    try:
+        if t == type(1.0) or t == type(1):
+            ret = fmt % value
+        elif t == type([]) or t == type(tuple()):
+            key = fmt, len(value)
+            if not key in vector_formats:
+                vector_formats[key] = '[' + ', '.join([fmt]*len(value)) + ']'
+            ret = vector_formats[key] % tuple(value)
+        else:
+            return round_value(value, fmt)
+    except TypeError: # nested or non numeric vector
+        return round_value(list(value), fmt)
+    if 'n' in ret: # nan or inf
+        return round_value(list(value) if t == type(tuple()) else value, fmt)
+    return ret
+
 class RoundedValue(Value):
     def __init__(self, name, initial, **kwargs):
       super(RoundedValue, self).__init__(name, initial, **kwargs)
       
-    def get_pypilot(self):
-      return '{"' + self.name + '": {"value": ' + round_value(self.value, '%.3f') + '}}'
+    def encode_value(self, value):
+      return format_value(value, '%.3f')
+
+    def encoding(self):
+      return '%.3f'
 
 class StringValue(Value):
     def __init__(self, name, initial, **kwargs):
         super(StringValue, self).__init__(name, initial, **kwargs)
 
-    def get_pypilot(self):
-        if type(self.value) == type(False):
-            strvalue = 'true' if self.value else 'false'
-        else:
-            strvalue = '"' + self.value + '"'
-        return '{"' + self.name + '": {"value": ' + strvalue + '}}'
+    def encode_value(self, value):
+        if type(value) == type(False):
+            return 'true' if value else 'false'
+        return pyjson.dumps(value)
+
+    def encoding(self):
+        return 'string'
 
 class SensorValue(Value):
     def __init__(self, name, initial=False, fmt='%.3f', **kwargs):
@@ -99,11 +168,11 @@ class SensorValue(Value):
             return {'type': 'SensorValue', 'directional': True}
         return 'SensorValue'
 
-    def get_pypilot(self):
-        value = self.value
-        if type(value) == type(tuple()):
-            value = list(value)
-        return '{"' + self.name + '": {"value": ' + round_value(value, self.fmt) + '}}'
+    def encode_value(self, value):
+        return format_value(value, self.fmt)
+
+    def encoding(self):
+        return self.fmt
 
 # a value that may be modified by external clients
 class Property(Value):
@@ -135,8 +204,11 @@ class RangeProperty(Property):
     def type(self):
         return {'type' : 'RangeProperty', 'min' : self.min_value, 'max' : self.max_value}
 
-    def get_pypilot(self):
-        return '{"' + self.name + ('": {"value": %.4f}}' % self.value)
+    def encode_value(self, value):
+        return '%.4f' % value
+
+    def encoding(self):
+        return '%.4f'
         
     def set(self, value):
         if value >= self.min_value and value <= self.max_value:
@@ -145,6 +217,7 @@ class RangeProperty(Property):
     def set_max(self, max_value):
         if self.value > max_value:
             self.value = max_value
+            self.encoded = False
         self.max_value = max_value
 
 # a range property that is persistent and specifies the units
@@ -194,9 +267,11 @@ class BooleanValue(Value):
     def __init__(self, name, initial, **kwargs):
         super(BooleanValue, self).__init__(name, initial, **kwargs)
 
-    def get_pypilot(self):
-        strvalue = 'true' if self.value else 'false'
-        return '{"' + self.name + '": {"value": ' + strvalue + '}}'
+    def encode_value(self, value):
+        return 'true' if value else 'false'
+
+    def encoding(self):
+        return 'bool'
 
 class BooleanProperty(Property):
     def __init__(self, name, initial, **kwargs):
@@ -205,9 +280,71 @@ class BooleanProperty(Property):
     def type(self):
         return 'BooleanProperty'
 
-    def get_pypilot(self):
-        strvalue = 'true' if self.value else 'false'
-        return '{"' + self.name + '": {"value": ' + strvalue + '}}'
+    def encode_value(self, value):
+        return 'true' if value else 'false'
+
+    def encoding(self):
+        return 'bool'
 
     def set(self, value):
         super(BooleanProperty, self).set(not not value)
+
+def readable_timespan(total):
+    mods = [('s', 1), ('m', 60), ('h', 60), ('d', 24), ('y', 365.24)]
+    def loop(i, mod):
+        if i == len(mods) or (int(total / (mods[i][1]*mod)) == 0 and i > 0):
+            return ''
+        if i < len(mods) - 1:
+            div = mods[i][1]*mods[i+1][1]*mod
+            t = int(total%int(div))
+        else:
+            t = total
+        return loop(i+1, mods[i][1]*mod) + (('%d' + mods[i][0] + ' ') % (t/(mods[i][1]*mod)))
+    return loop(0, 1)
+
+# everything another process needs to serve a value, the type
+# includes any range or choices for clients listing values
+def value_schema(value):
+    return {'name': value.name, 'type': value.type(), 'value': value.value,
+            'persistent': value.persistent, 'client_can_set': value.client_can_set,
+            'fmt': value.encoding()}
+
+# a value rebuilt from its schema, it only holds and encodes the
+# latest value since sets are applied by the process which owns it
+class MirrorValue(Value):
+    def __init__(self, schema):
+        self.schema_type = schema['type']
+        self.fmt = schema['fmt']
+        super(MirrorValue, self).__init__(schema['name'], schema['value'], persistent=schema['persistent'])
+        self.client_can_set = schema['client_can_set']
+
+    def type(self):
+        return self.schema_type
+
+    def get_pypilot(self):
+        if self.fmt == 'age': # changes with time
+            self.encoded = False
+        return super(MirrorValue, self).get_pypilot()
+
+    def encode_value(self, value):
+        fmt = self.fmt
+        if not fmt:
+            return super(MirrorValue, self).encode_value(value)
+        if type(fmt) == type([]): # fields of a dict
+            if not value:
+                return 'false'
+            items = [pyjson.dumps(field) + ': ' + format_value(value[field], f) for field, f in fmt]
+            return '{' + ', '.join(items) + '}'
+        if type(fmt) == type({}): # names of set bits
+            return '"' + ''.join([name + ' ' for bit, name in fmt['flags'] if value & bit]) + '"'
+        if fmt == 'json':
+            return pyjson.dumps(value)
+        if fmt == 'bool' or (fmt == 'string' and type(value) == type(False)):
+            return 'true' if value else 'false'
+        if fmt == 'string':
+            return pyjson.dumps(value)
+        if fmt == 'timespan':
+            return '"' + readable_timespan(value) + '"'
+        if fmt == 'age':
+            return '"' + readable_timespan(max(0, time.time() - value)) + '"'
+        return format_value(value, fmt)
@@ -8,6 +8,12 @@
 # version 3 of the License, or (at your option) any later version.  
 
 import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
 def lmap(*cargs):
     return list(map(*cargs))
 
@@ -45,3 +51,18 @@ def dist(a, b):
 
 def dist2(a, b):
     return (a[0] - b[0])**2 + (a[1] - b[1])**2 + (a[2] - b[2])**2
+
+# batch versions operate on numpy arrays of shape (N, 3)
+def norm_batch(v):
+    return numpy.linalg.norm(v, axis=-1)
+
+def normalize_batch(v):
+    v = numpy.asarray(v, dtype=float)
+    n = norm_batch(v)[..., None]
+    return v / numpy.where(n == 0, 1, n)
+
+def dot_batch(a, b):
+    return numpy.sum(numpy.multiply(a, b), axis=-1)
+
+def cross_batch(a, b):
+    return numpy.cross(a, b)
@@ -89,6 +89,7 @@ setup (name = 'pypilot',
            'console_scripts': [
                'pypilot=pypilot.autopilot:main',
                'pypilot_boatimu=pypilot.boatimu:main',
+               'pypilot_imu_replay=pypilot.imu_replay:main',
                'pypilot_servo=pypilot.servo:main',
                'pypilot_web=pypilot.web.web:main',
                'pypilot_hat=pypilot.hat.hat:main',
@@ -427,16 +427,12 @@ def main():
     
     print('connected')
     def idle():
-        while True:
-            try:
-                result = client.receive_single()
-                if result:
-                    plot.read_data(result)
-                else:
-                    time.sleep(.01)
-                    break
-            except:
-                pass
+        try:
+            for result in client.messages():
+                plot.read_data(result)
+        except:
+            pass
+        time.sleep(.01)
 
     glutInit(sys.argv)
     glutInitWindowPosition(250, 0)
@@ -14,6 +14,7 @@ from flask import Flask, render_template, session, request, Markup
 from flask_socketio import SocketIO, Namespace, emit, join_room, leave_room, \
     close_room, rooms, disconnect
 from pypilot.server import LineBufferedNonBlockingSocket
+from pypilot.client import pypilotConnection
 
 pypilot_web_port=80
 if len(sys.argv) > 1:
@@ -111,10 +112,9 @@ class MyNamespace(Namespace):
 
     def connect_pypilot(self):
         print('connect pypilot...')
-        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         socketio.emit('flush') # unfortunately needed to awaken socket for client messages
         try:
-            connection.connect(('localhost', DEFAULT_PORT))
+            connection = pypilotConnection('localhost', DEFAULT_PORT)
         except:
             socketio.sleep(2)
             return